@@ -10,3 +10,9 @@ def add_argument(*args, **kwargs):
 
 def parse_args(*args, **kwargs):
   ARGS_PARSER.parse_args(*args, namespace=ARGS, **kwargs)
+
+def set_defaults(**kwargs):
+  ARGS_PARSER.set_defaults(**kwargs)
+
+def error(message):
+  ARGS_PARSER.error(message)
@@ -1,8 +1,11 @@
 #!/usr/bin/python
 # Copyright 2013 Russell Heilling
 '''Access data for comics stored in calibre.'''
+from collections import defaultdict
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+import shutil
 import sys
 
 # Calibre modules cannot be loaded outside the calibre environment so disable
@@ -10,13 +13,27 @@ import sys
 import calibre_config                                  #pylint: disable=W0611
 import calibre.constants                               #pylint: disable=F0401
 from calibre.library.database2 import LibraryDatabase2 #pylint: disable=F0401
-from calibre.library.save_to_disk import save_to_disk  #pylint: disable=F0401
 from calibre.utils.config import prefs                 #pylint: disable=F0401
+from calibre.utils.date import strftime                #pylint: disable=F0401
+from calibre.utils.filenames import (                  #pylint: disable=F0401
+  ascii_filename, shorten_components_to, supports_long_names)
 import calibre.utils.logging as calibre_logging        #pylint: disable=F0401
 
-# Some modules get a copy of calibre.constants.DEBUG before we can set
-# it false. Override them here
-sys.modules[save_to_disk.__module__].DEBUG = False
+
+def link_or_copy(source, target):
+  '''Hardlink source to target if they share a filesystem, otherwise copy.
+
+  Falls back to copying if the filesystem does not support links.
+  '''
+  target_dir = os.path.dirname(target)
+  if os.stat(source).st_dev == os.stat(target_dir).st_dev:
+    try:
+      os.link(source, target)
+      return
+    except OSError as err:
+      logging.debug('Unable to link %s: %s', source, err)
+  shutil.copyfile(source, target)
+
 
 class CalibreDB(LibraryDatabase2):
   '''Interface to the calibre database.
@@ -27,19 +44,14 @@ class CalibreDB(LibraryDatabase2):
     'Options for exporting files from library'
     # This class is a pure namespace so ignore the fact there are no methods
     # pylint: disable=R0903
-    asciiize = True
-    formats = 'cbr,cbz'
-    replace_whitespace = False
-    save_cover = False
-    single_dir = True
-    template = '{pubdate} {title} ({id})'
+    formats = ('cbr', 'cbz')
+    template = '%(pubdate)s %(title)s (%(id)d)'
+    threads = 4
     timefmt = '%Y%m%d'
-    to_lowercase = False
-    update_metadata = False
-    write_opf = False
 
   def __init__(self):
     LibraryDatabase2.__init__(self, prefs['library_path'])
+    self._volume_index = None
 
   def issue(self, issueid):
     'Retrieve an issue by calibre id'
@@ -51,30 +63,145 @@ class CalibreDB(LibraryDatabase2):
       return metadata
     return None
 
+  def issues(self, issueids):
+    '''Retrieve several issues by calibre id.  Returns a dict keyed by id.
+
+    Ids not in the library are left out.
+    '''
+    issues = {}
+    for issueid in issueids:
+      try:
+        metadata = self.issue(issueid)
+      except ValueError:
+        logging.debug('No issue with id %d', issueid)
+        continue
+      if metadata:
+        issues[issueid] = metadata
+    return issues
+
+  def volume_index(self, refresh=False):
+    '''Map comicvine volume ids to the calibre ids tagged with them.
+
+    The index is built from a single pass over the identifiers table and
+    reused for the life of the object unless refresh is set.
+    '''
+    if self._volume_index is None or refresh:
+      index = defaultdict(set)
+      for (calibre_id, volumeid) in self.conn.get(
+          "SELECT book, val FROM identifiers WHERE type='comicvine-volume'"):
+        try:
+          index[int(volumeid)].add(calibre_id)
+        except ValueError:
+          logging.warn('Invalid comicvine-volume for issue %d: %r',
+                       calibre_id, volumeid)
+      logging.debug('Indexed %d volumes', len(index))
+      self._volume_index = index
+    return self._volume_index
+
   def volume(self, volumeid):
-    'Retrieve data on a volume by comicvine volume id'
-    pass
-
-  def export_files(self, titles, syncdir):
-    'Export selected ids to specified directory'
-    def export_progress(calibre_id, title, failed, traceback):
-      'Callback used for progress updates during the export operation.'
-      if failed:
-        logging.error('Unable to export %s(%s): %s',
-                      title, calibre_id, traceback)
-      else:
-        logging.info('Exported %s(%s)', title, calibre_id)
-      return not(failed)
-
-    opts = self.ExportFile()
+    'Retrieve the calibre ids of issues in a volume by comicvine volume id'
+    return self.volume_index().get(volumeid, set())
+
+  def last_modified(self):
+    'Return the most recent modification time of any issue in the library.'
+    return self.conn.get('SELECT MAX(last_modified) FROM books', all=False)
+
+  def modified_times(self):
+    'Return a dict mapping calibre ids to their last_modified time.'
+    return dict(self.conn.get(
+      'SELECT id, CAST(last_modified AS TEXT) FROM books'))
+
+  def changed_volumes(self, since):
+    'Return the comicvine volume ids of issues modified after since.'
+    volumes = set()
+    for (volumeid,) in self.conn.get(
+        "SELECT DISTINCT identifiers.val FROM identifiers "
+        "JOIN books ON books.id = identifiers.book "
+        "WHERE identifiers.type='comicvine-volume' "
+        "AND books.last_modified > ?", (since,)):
+      try:
+        volumes.add(int(volumeid))
+      except ValueError:
+        logging.warn('Invalid comicvine-volume: %r', volumeid)
+    return volumes
+
+  def _export_source(self, calibre_id, length):
+    '''Find the library file to export for an issue and its export filename.
+
+    As with calibre's save_to_disk the filename is made ascii and
+    shortened to fit within length characters.
+    '''
+    opts = self.ExportFile
+    for fmt in opts.formats:
+      source = self.format_abspath(calibre_id, fmt, index_is_id=True)
+      if source:
+        break
+    else:
+      raise ValueError('No %s file for issue %d' % (
+        '/'.join(opts.formats), calibre_id))
+    metadata = self.issue(calibre_id)
+    name = ascii_filename(opts.template % {
+      'pubdate': strftime(opts.timefmt, metadata.pubdate),
+      'title': metadata.title,
+      'id': calibre_id,
+    })
+    (name,) = shorten_components_to(length, [name],
+                                    more_chars=len(fmt) + 1)
+    return source, '%s.%s' % (name, fmt)
+
+  def export_files(self, titles, syncdir, link=False):
+    '''Export selected ids to specified directory
+
+    Files are copied by a small pool of threads.  With link set they are
+    hardlinked from the library where possible instead, so any change to
+    an exported file also changes the library copy.  syncdir is updated
+    with each file as it is exported.
+    '''
+    opts = self.ExportFile
     ids = [int(idx) for idx in list(set(titles)-set(syncdir.keys()))]
     logging.info('Exporting %d titles...', len(ids))
-    failures = save_to_disk(
-      self, ids, syncdir.directory, opts=opts, callback=export_progress)
-    # Callback does not recieve the filename, so rather than updating
-    # syncdir as files are added we need to rescan once the export is
-    # complete...
-    syncdir.scan()
+    failures = []
+    jobs = []
+    # Path length limits as used by calibre's save_to_disk.
+    root = os.path.abspath(syncdir.directory)
+    length = (1000 if supports_long_names(root) else 240) - len(root) - 1
+    # Resolve paths before starting the pool so that only file
+    # operations happen outside this thread.
+    for calibre_id in ids:
+      try:
+        source, filename = self._export_source(calibre_id, length)
+      except (ValueError, OSError) as err:
+        logging.error('Unable to export %s: %s', calibre_id, err)
+        failures.append((calibre_id, str(err)))
+        continue
+      jobs.append((calibre_id, source, filename))
+
+    def export_file(job):
+      'Export a single file, returning any error.'
+      calibre_id, source, filename = job
+      target = os.path.join(syncdir.directory, filename)
+      try:
+        if link:
+          link_or_copy(source, target)
+        else:
+          shutil.copyfile(source, target)
+      except (IOError, OSError) as err:
+        return calibre_id, filename, err
+      return calibre_id, filename, None
+
+    pool = ThreadPool(opts.threads)
+    try:
+      for calibre_id, filename, err in pool.imap_unordered(export_file, jobs):
+        if err:
+          logging.error('Unable to export %s(%s): %s',
+                        filename, calibre_id, err)
+          failures.append((calibre_id, str(err)))
+          continue
+        logging.info('Exported %s(%s)', filename, calibre_id)
+        syncdir[str(calibre_id)] = filename
+    finally:
+      pool.close()
+      pool.join()
     if failures:
       logging.warn('Unable to export files: %s', repr(failures))
 
@@ -6,11 +6,12 @@
 Manage titles on pull-list and add new titles to toread list.
 '''
 import logging
+import multiprocessing
 import os
 
 import args
-from calibredb import CalibreDB
 import logs
+from metadatadb import open_library
 from pulldb import PullList
 from toread import ReadingList
 
@@ -23,28 +24,49 @@ args.add_argument('--pulldb', '-p', help='Location of pull database',
                   default=os.path.join(os.environ['HOME'], '.pull.db'))
 args.add_argument('--volume', help='Volume to pull',
                   action='append')
-args.add_argument('--workers', help='Number of worker threads.',
+args.add_argument('--workers', help='Number of worker processes.',
                   default=1, type=int)
-args.add_argument('--shard', help='The task number to run',
-                  default=0, type=int)
+args.add_argument('--shard', type=int,
+                  help='Only check this shard of the volumes in this process.  '
+                       'Shards are numbered from 0 to workers-1.')
+args.add_argument('--full', action='store_true',
+                  help='Check all pulled volumes, not just those with issues '
+                       'changed since the last run.')
 
-def check_new(volume, pull_list=None, calibredb=None):
+# pull_state key for the calibre last_modified high-water mark.
+WATERMARK = 'calibre_last_modified'
+
+# Database connections for pool worker processes.  Set up by init_worker.
+WORKER = {}
+
+def check_new(volume, pull_list=None, calibredb=None, seen_issues=None):
+  '''Find issues in the calibre database that have not been pulled.
+
+  seen_issues may be provided to avoid looking up the seen issues for
+  the volume individually.
+  '''
   logging.debug('Checking volume %d for new issues', volume)
-  seen_issues = pull_list.seen_issues(volume)
+  if seen_issues is None:
+    seen_issues = pull_list.seen_issues(volume)
   new_issues = set()
   logging.debug('Checking for issues in Calibre Database for volume %d',
                 volume)
-  issues = calibredb.search(
-    query='identifiers:comicvine-volume:%d' % volume, return_matches=True)
+  issues = sorted(calibredb.volume(volume))
+  candidates = []
   for issueid in issues:
     if issueid in seen_issues:
       logging.debug('Issue %d already seen in volume %d', 
                     issueid, volume)
       continue
-    # Sometimes issues will be retagged after being pulled.  Double
-    # check that the issue isn't in the database associated with a
-    # different volume before pulling.
-    if pull_list.seen_issue(issueid):
+    candidates.append(issueid)
+  # Sometimes issues will be retagged after being pulled.  Double
+  # check that the issue isn't in the database associated with a
+  # different volume before pulling.
+  retagged = set()
+  if candidates:
+    retagged = pull_list.seen_issue_set(candidates)
+  for issueid in candidates:
+    if issueid in retagged:
       logging.warn('Issue %d seen but not associated with volume %d',
                    issueid, volume)
       continue
@@ -55,28 +77,96 @@ def check_new(volume, pull_list=None, calibredb=None):
     new_issues.add((issueid, issue.title, volume, cvid))
   return new_issues
 
-def sharded_to_us(volume):
-  return volume % ARGS.workers == ARGS.shard
+def check_volumes(volumes, pull_list, calibredb):
+  'Check a list of volumes for new issues.'
+  new_issues = set()
+  seen_issues = pull_list.seen_volume_issues(volumes)
+  for volume in volumes:
+    new_issues.update(
+      check_new(volume, pull_list=pull_list, calibredb=calibredb,
+                seen_issues=seen_issues[volume]))
+  return new_issues
+
+def init_worker(pulldb):
+  'Open database connections for a pool worker process.'
+  WORKER['pull_list'] = PullList(pulldb)
+  WORKER['calibredb'] = open_library()
+
+def check_shard(volumes):
+  'Pool task: check a shard of volumes using the worker connections.'
+  return check_volumes(volumes, WORKER['pull_list'], WORKER['calibredb'])
+
+def shard_volumes(volumes, workers):
+  'Split volumes into shards, one per worker.'
+  shards = [[] for _ in range(workers)]
+  for volume in volumes:
+    shards[volume % workers].append(volume)
+  return shards
 
 def pull_issues(pull_list):
-  'Check for unseen issues in database and add them to toread list.'
-  calibredb = CalibreDB()
+  '''Check for unseen issues in database and add them to toread list.
+
+  Unless a full check is requested only volumes with issues modified in
+  calibre since the last run, or with no issues seen yet, are checked.
+  With more than one worker the volumes are checked by a pool of
+  processes and the results merged here, so only this process writes
+  to the toread list and pull database.
+  '''
+  calibredb = open_library()
+  watermark = calibredb.last_modified()
+  last_run = pull_list.state(WATERMARK)
   # Check database for new issues for pull volumes
   new_issues = set()
   if ARGS.volume:
     volumes = map(int, ARGS.volume)
   else:
-    volumes = pull_list.volumes()
-  for volume in volumes:
-    if sharded_to_us(volume):
-      new_issues.update(
-        check_new(volume, pull_list=pull_list, calibredb=calibredb))
+    volumes = list(pull_list.volumes())
+  if ARGS.shard is not None:
+    volumes = shard_volumes(volumes, ARGS.workers)[ARGS.shard]
+  if last_run and not (ARGS.full or ARGS.volume):
+    changed = calibredb.changed_volumes(last_run)
+    seen_issues = pull_list.seen_volume_issues(volumes)
+    volumes = [volume for volume in volumes
+               if volume in changed or not seen_issues[volume]]
+    logging.info('Checking %d volumes changed since %s',
+                 len(volumes), last_run)
+  if ARGS.workers > 1 and ARGS.shard is None:
+    pool = multiprocessing.Pool(ARGS.workers, init_worker, (ARGS.pulldb,))
+    try:
+      for shard_issues in pool.imap_unordered(
+          check_shard, shard_volumes(volumes, ARGS.workers)):
+        new_issues.update(shard_issues)
+    except:
+      pool.terminate()
+      raise
+    else:
+      pool.close()
+    finally:
+      pool.join()
+  else:
+    new_issues = check_volumes(volumes, pull_list, calibredb)
   # Update toread list
   if new_issues:
     toread = ReadingList(ARGS.todo_file)
     toread.add_issues(new_issues)
-    for (issue, _, volume, cvid) in new_issues:
-      pull_list.add_issue(int(issue), volume, cvid)
+    metadata = calibredb.issues([int(issue) for (issue, _, _, _) in new_issues])
+    with pull_list.transaction():
+      pull_list.add_issues(
+        (int(issue), volume, cvid) for (issue, _, volume, cvid) in new_issues)
+      pull_list.update_latest_issues(
+        (volume, metadata[int(issue)].pubdate)
+        for (issue, _, volume, _) in new_issues if int(issue) in metadata)
+  # Only a complete pass can move the high-water mark forward.
+  if watermark and not ARGS.volume and ARGS.shard is None:
+    pull_list.state(WATERMARK, watermark)
+
+def check_args():
+  'Report a usage error for invalid worker and shard arguments.'
+  if ARGS.workers < 1:
+    args.error('--workers must be at least 1')
+  if ARGS.shard is not None and not 0 <= ARGS.shard < ARGS.workers:
+    args.error('--shard must be from 0 to %d (--workers - 1)' % (
+      ARGS.workers - 1))
 
 def main():
   'Check for new issues to pull.'
@@ -85,5 +175,6 @@ def main():
 
 if __name__ == '__main__':
   args.parse_args()
+  check_args()
   logs.set_logging()
   main()
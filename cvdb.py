@@ -1,106 +1,1048 @@
 # Copyright 2013 Russell Heilling
 'Functions and classes for accessing comicvine data'
 
+from collections import deque
 from datetime import date, datetime, timedelta
+import heapq
+import httplib
+import json
 import logging
+from math import ceil
+from multiprocessing.pool import ThreadPool
 import os
 import random
+import socket
+import sqlite3
 import time
 import threading
+import urllib
+import urlparse
 
 import pycomicvine
-from pycomicvine import Issue, Issues, Volume, Volumes
 from pycomicvine.error import InvalidResourceError
 
 import api_key # pylint: disable=W0611
+import args
+from pulldb import parse_db_date
 
-def volume_details(volumes):
+args.add_argument('--cv_cache', help='Location of comicvine response cache',
+                  default=os.path.join(os.environ['HOME'], '.comicvine.db'))
+args.add_argument('--offline', action='store_true',
+                  help='Only use cached comicvine responses.')
+args.add_argument('--cv_rate', type=float, default=2.0,
+                  help='Maximum comicvine requests per second.')
+args.add_argument('--cv_concurrency', type=int, default=4,
+                  help='Number of concurrent comicvine requests.')
+ARGS = args.ARGS
+
+API_URL = 'http://api.comicvine.com'
+
+# Bounds on the ids joined into a single filter.  Long filters make URLs
+# that comicvine truncates or rejects.
+FILTER_IDS = 100
+FILTER_LENGTH = 1000
+
+
+class ComicVineError(Exception):
+  'Error returned by the comicvine API.'
+
+
+class OfflineError(ComicVineError):
+  'Response is not cached and comicvine may not be contacted.'
+
+
+class CancelledError(ComicVineError):
+  'A page read ahead is no longer wanted.'
+
+
+class TokenBucket(object):
+  '''Token bucket rate limiter shared by all request threads.
+
+  Allows bursts of up to capacity requests, refilling at rate tokens
+  per second.
+  '''
+  def __init__(self, rate, capacity=None):
+    self.rate = rate
+    self.capacity = capacity or max(1, int(rate))
+    self.tokens = self.capacity
+    self.updated = time.time()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    'Wait until a request may be made.'
+    while True:
+      with self.lock:
+        now = time.time()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+  def drain(self):
+    'Empty the bucket, e.g. when the server reports it is busy.'
+    with self.lock:
+      self.tokens = 0
+      self.updated = time.time()
+
+
+def parse_date(value):
+  'Convert a comicvine date or timestamp to a datetime.'
+  if not value:
+    return None
+  for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+    try:
+      return datetime.strptime(value, fmt)
+    except ValueError:
+      continue
+  raise ValueError('Unable to parse date: %r' % value)
+
+
+def filter_chunks(ids, size=FILTER_IDS, length=FILTER_LENGTH):
+  '''Split ids into '|' separated filter values of bounded size.
+
+  ids are sorted so the same set of ids always gives the same chunks
+  (and so the same cached responses).
+  '''
+  chunk = []
+  chunk_length = 0
+  for value in sorted(set(ids)):
+    value = str(value)
+    if chunk and (len(chunk) >= size or
+                  chunk_length + len(value) + 1 > length):
+      yield '|'.join(chunk)
+      chunk, chunk_length = [], 0
+    chunk.append(value)
+    chunk_length += len(value) + 1
+  if chunk:
+    yield '|'.join(chunk)
+
+
+class Descending(object):
+  'Sort key wrapper that reverses the order of the wrapped value.'
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __eq__(self, other):
+    return self.value == other.value
+
+  def __lt__(self, other):
+    return other.value < self.value
+
+
+def merge_sorted(streams, key, reverse=False):
+  '''Merge already sorted streams into a single sorted stream.
+
+  Only the head of each stream is held, so results are generated as
+  soon as every stream has produced its first item.
+  '''
+  if reverse:
+    sort_key = lambda item: Descending(key(item))
+  else:
+    sort_key = key
+  heap = []
+  for index, stream in enumerate(streams):
+    stream = iter(stream)
+    for item in stream:
+      heap.append((sort_key(item), index, item, stream))
+      break
+  heapq.heapify(heap)
+  while heap:
+    _, index, item, stream = heap[0]
+    yield item
+    for item in stream:
+      heapq.heapreplace(heap, (sort_key(item), index, item, stream))
+      break
+    else:
+      heapq.heappop(heap)
+
+
+class Resource(object):
+  '''A comicvine resource built from an API response.
+
+  Only the fields requested are present.  Resources of the same type
+  compare equal when their ids match.
+  '''
+  date_fields = ('store_date', 'cover_date', 'date_added',
+                 'date_last_updated')
+
+  def __init__(self, data):
+    self.data = data
+    for field, value in data.items():
+      if field in self.date_fields:
+        value = parse_date(value)
+      setattr(self, field, value)
+
+  def __eq__(self, other):
+    return type(self) == type(other) and self.id == other.id
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash((type(self).__name__, self.id))
+
+  def __repr__(self):
+    return '%s(%r)' % (type(self).__name__, getattr(self, 'id', None))
+
+
+class Volume(Resource):
+  'A comicvine volume.'
+  def __init__(self, data):
+    super(Volume, self).__init__(data)
+    if getattr(self, 'start_year', None):
+      try:
+        self.start_year = int(self.start_year)
+      except ValueError:
+        self.start_year = None
+
+
+class Issue(Resource):
+  'A comicvine issue.'
+  def __init__(self, data):
+    super(Issue, self).__init__(data)
+    if isinstance(getattr(self, 'volume', None), dict):
+      self.volume = Volume(self.volume)
+
+
+class ResponseCache(object):
+  '''On-disk cache of comicvine API responses.
+
+  Responses are fresh for ttl seconds after they are fetched.  After
+  that they may still be served for up to stale seconds while a fresh
+  copy is fetched in the background.
+  '''
+  day = 24 * 60 * 60
+  # (ttl, stale) per resource.
+  lifetimes = {
+    'volumes': (30 * day, 365 * day),
+    'issues': (day / 4, 7 * day),
+  }
+  default_lifetime = (day, 7 * day)
+
+  def __init__(self, cache_file):
+    self.cache_file = cache_file
+    self._local = threading.local()
+    with self.conn:
+      self.conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                        'key TEXT PRIMARY KEY, fetched REAL, body TEXT)')
+    self.prune()
+
+  @property
+  def conn(self):
+    'The cache connection for the current thread.'
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.cache_file, timeout=30)
+      conn.execute('PRAGMA journal_mode=WAL')
+      conn.execute('PRAGMA synchronous=NORMAL')
+      self._local.conn = conn
+    return conn
+
+  @staticmethod
+  def key(resource, params):
+    'Cache key for a request.'
+    return '%s?%s' % (resource, urllib.urlencode(sorted(params.items())))
+
+  def lifetime(self, resource):
+    'Return the (ttl, stale) lifetimes for a resource.'
+    return self.lifetimes.get(resource, self.default_lifetime)
+
+  def prune(self):
+    '''Delete responses that are too old to be served.
+
+    Each resource keeps responses for its own stale lifetime; anything
+    else is kept for the default lifetime.
+    '''
+    now = time.time()
+    with self.conn:
+      deleted = 0
+      for resource, (_, stale) in self.lifetimes.items():
+        deleted += self.conn.execute(
+          'DELETE FROM responses WHERE key LIKE ? AND fetched < ?',
+          (resource + '?%', now - stale)).rowcount
+      others = ' AND '.join(['key NOT LIKE ?'] * len(self.lifetimes))
+      deleted += self.conn.execute(
+        'DELETE FROM responses WHERE fetched < ? AND ' + others,
+        [now - self.default_lifetime[1]] +
+        [resource + '?%' for resource in self.lifetimes]).rowcount
+    if deleted:
+      logging.debug('Pruned %d stale responses from %s', deleted,
+                    self.cache_file)
+
+  def get(self, key):
+    'Return (age, response) for a cached response, or (None, None).'
+    row = self.conn.execute(
+      'SELECT fetched, body FROM responses WHERE key=?', (key,)).fetchone()
+    if row:
+      return time.time() - row[0], json.loads(row[1])
+    return None, None
+
+  def put(self, key, response):
+    'Store a response.'
+    with self.conn:
+      self.conn.execute(
+        'INSERT OR REPLACE INTO responses (key, fetched, body) '
+        'VALUES (?,?,?)', (key, time.time(), json.dumps(response)))
+
+
+class ComicVine(object):
+  '''Minimal comicvine API client.
+
+  Requests are limited by a shared token bucket and made over
+  persistent connections, one per thread.  Busy responses (HTTP
+  420/429/503 or a rate limit status) are retried with exponential
+  backoff.  Responses are cached by resource and query parameters so
+  that repeat runs do not need to fetch data that rarely changes.
+  '''
+  page_size = 100
+  retries = 5
+  backoff = 1.0
+  busy_status = (420, 429, 503)
+  rate_limit_code = 107
+  resource_types = {
+    'volumes': Volume,
+    'issues': Issue,
+  }
+
+  def __init__(self, base_url=API_URL, key=None, cache=None, offline=False,
+               rate=2.0, concurrency=4):
+    self.base_url = base_url
+    url = urlparse.urlparse(base_url)
+    self.scheme, self.host, self.path = url.scheme, url.netloc, url.path
+    self.key = key or pycomicvine.api_key
+    self.cache = cache
+    self.offline = offline
+    self.limiter = TokenBucket(rate)
+    self.concurrency = concurrency
+    self._pool = None
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self.requests = 0
+    self.bytes = 0
+
+  @property
+  def pool(self):
+    'Thread pool used to fetch pages concurrently.'
+    with self._lock:
+      if self._pool is None:
+        self._pool = ThreadPool(self.concurrency)
+    return self._pool
+
+  def connection(self, reset=False):
+    'The persistent connection for the current thread.'
+    conn = getattr(self._local, 'conn', None)
+    if conn is not None and reset:
+      conn.close()
+      conn = None
+    if conn is None:
+      if self.scheme == 'https':
+        conn = httplib.HTTPSConnection(self.host, timeout=60)
+      else:
+        conn = httplib.HTTPConnection(self.host, timeout=60)
+      self._local.conn = conn
+    return conn
+
+  def _cancelled(self):
+    'Raise CancelledError if the page being fetched is no longer wanted.'
+    cancelled = getattr(self._local, 'cancelled', None)
+    if cancelled is not None and cancelled.is_set():
+      raise CancelledError('Page no longer wanted')
+
+  def _get(self, url):
+    'Make a single GET request, returning (status, body).'
+    self._cancelled()
+    self.limiter.acquire()
+    # Waiting for the rate limit may have taken a while.
+    self._cancelled()
+    with self._lock:
+      self.requests += 1
+    try:
+      conn = self.connection()
+      conn.request('GET', url)
+      response = conn.getresponse()
+      body = response.read()
+    except (httplib.HTTPException, socket.error):
+      # The server may have closed an idle connection.  Try once more
+      # on a new one.
+      conn = self.connection(reset=True)
+      conn.request('GET', url)
+      response = conn.getresponse()
+      body = response.read()
+    with self._lock:
+      self.bytes += len(body)
+    return response.status, body
+
+  def request(self, resource, params):
+    'Fetch a response from the API.'
+    query = dict(params, api_key=self.key, format='json')
+    url = '%s/%s/?%s' % (self.path, resource, urllib.urlencode(query))
+    logging.debug('Fetching %s %r', resource, params)
+    for attempt in range(self.retries + 1):
+      try:
+        status, body = self._get(url)
+      except (httplib.HTTPException, socket.error) as err:
+        status, body = None, str(err)
+      response = None
+      if status == 200:
+        try:
+          response = json.loads(body)
+        except ValueError:
+          body = 'Invalid response: %r' % body[:100]
+      if response and response.get('status_code') == 1:
+        break
+      if response:
+        body = response.get('error')
+      busy = (status in self.busy_status or status is None or
+              (response and response.get('status_code') ==
+               self.rate_limit_code))
+      if not busy or attempt == self.retries:
+        raise ComicVineError('Error fetching %s: %s %s' % (
+          resource, status, body))
+      self.limiter.drain()
+      delay = self.backoff * 2 ** attempt * (1 + random.random())
+      logging.info('Comicvine busy (%s), retrying in %.1fs', status, delay)
+      time.sleep(delay)
+    if self.cache:
+      self.cache.put(self.cache.key(resource, params), response)
+    return response
+
+  def _revalidate(self, resource, params):
+    'Refresh a stale cache entry.'
+    try:
+      self.request(resource, params)
+    except ComicVineError as err:
+      logging.warn('Unable to refresh %s: %s', resource, err)
+
+  def page(self, resource, params, stale_ok=True):
+    '''Return one page of results for a request, from the cache if possible.
+
+    Unless stale_ok is unset a stale cached page is returned while it is
+    refreshed in the background.  Offline any cached page is returned.
+    '''
+    if self.cache:
+      age, response = self.cache.get(self.cache.key(resource, params))
+      if response:
+        ttl, stale = self.cache.lifetime(resource)
+        if self.offline or age < ttl:
+          return response
+        if stale_ok and age < stale:
+          logging.debug('Serving stale %s %r', resource, params)
+          self.pool.apply_async(self._revalidate, (resource, params))
+          return response
+    if self.offline:
+      raise OfflineError('No cached response for %s %r' % (resource, params))
+    return self.request(resource, params)
+
+  def pages(self, resource, start=0, readahead=None, raw=False,
+            stale_ok=True, **params):
+    '''Generate (offset, results) for each page of a request from start.
+
+    The first page is requested from the client pool straight away.
+    Once the number of results is known up to readahead further pages
+    (default: the client concurrency) are fetched concurrently.  Pages
+    are still generated in order.  With raw set results are the response
+    dicts rather than resources.  stale_ok is passed to page.
+    '''
+    for field in ('field_list', 'filter', 'sort'):
+      if isinstance(params.get(field), (list, tuple)):
+        params[field] = ','.join(params[field])
+    params = dict((field, value) for field, value in params.items()
+                  if value is not None)
+    first = self.pool.apply_async(
+      self.page, (resource, dict(params, offset=start, limit=self.page_size),
+                  stale_ok))
+    return self._pages(resource, params, start, first, readahead, raw,
+                       stale_ok)
+
+  def _readahead_page(self, cancelled, resource, params, stale_ok):
+    'Pool task: fetch a page read ahead unless it is no longer wanted.'
+    if cancelled.is_set():
+      return None
+    self._local.cancelled = cancelled
+    try:
+      return self.page(resource, params, stale_ok)
+    finally:
+      self._local.cancelled = None
+
+  def _pages(self, resource, params, start, first, readahead, raw, stale_ok):
+    '''Generate the pages of a request once the first has been requested.
+
+    Pages read ahead but not yet requested are skipped if the generator
+    is closed early.
+    '''
+    resource_type = self.resource_types.get(resource, Resource)
+    if raw:
+      resource_type = lambda result: result
+    if readahead is None:
+      readahead = self.concurrency
+    offset = start
+    response = first.get()
+    total = response.get('number_of_total_results', 0)
+    offsets = deque(range(start + self.page_size, total, self.page_size))
+    pending = deque()
+    cancelled = threading.Event()
+    try:
+      while True:
+        yield offset, [resource_type(result)
+                       for result in response.get('results') or []]
+        while offsets and (len(pending) < readahead or not pending):
+          next_offset = offsets.popleft()
+          pending.append((next_offset, self.pool.apply_async(
+            self._readahead_page,
+            (cancelled, resource, dict(params, offset=next_offset,
+                                       limit=self.page_size), stale_ok))))
+        if not pending:
+          break
+        offset, result = pending.popleft()
+        response = result.get()
+    finally:
+      cancelled.set()
+
+  # Pages fetched ahead of the consumer for each filter chunk.
+  chunk_readahead = 2
+
+  def fetch_many(self, resource, field, ids, sort=None, filter=None,
+                 **params):
+    '''Generate results whose field matches any of ids.
+
+    The ids are split into bounded filter chunks (see filter_chunks).
+    The first page of every chunk is requested at once, and all pages
+    are fetched by the client pool so no more than the client
+    concurrency are fetched at a time.  Results are generated in chunk
+    order, or merged into the requested sort order if sort is set.
+    Only a few pages per chunk are fetched ahead of the caller.  Any
+    extra filter applies to every chunk.
+    '''
+    # pylint: disable=W0622
+    streams = []
+    for chunk in filter_chunks(ids):
+      chunk_filter = '%s:%s' % (field, chunk)
+      if filter:
+        chunk_filter += ',' + filter
+      pages = self.pages(resource, readahead=self.chunk_readahead,
+                         filter=chunk_filter, sort=sort, **params)
+      streams.append(result for _, page in pages for result in page)
+    if sort:
+      sort_field, _, direction = sort.partition(':')
+      merged = merge_sorted(
+        streams, key=lambda result: getattr(result, sort_field, None),
+        reverse=direction == 'desc')
+    else:
+      merged = (result for stream in streams for result in stream)
+    for result in merged:
+      yield result
+
+
+CLIENT = {}
+
+def client():
+  'The comicvine client configured from the command line.'
+  if 'client' not in CLIENT:
+    cache = None
+    if getattr(ARGS, 'cv_cache', None):
+      cache = ResponseCache(ARGS.cv_cache)
+    CLIENT['client'] = ComicVine(
+      cache=cache, offline=getattr(ARGS, 'offline', False),
+      rate=getattr(ARGS, 'cv_rate', 2.0),
+      concurrency=getattr(ARGS, 'cv_concurrency', 4))
+  return CLIENT['client']
+
+
+def volume_details(volumes, sort=None):
   'Retrieve volume details from comicvine.'
-  volume_filter = '|'.join(str(volume) for volume in volumes)
-  return pycomicvine.Volumes(
-    filter='id:%s' % (volume_filter,), field_list=['id', 'name', 'start_year'])
-
-def issue_details(volumes, sort=None):
-  'Retrieve issue details from comicvine.'
-  volume_filter = '|'.join(str(volume) for volume in volumes)
-  return pycomicvine.Issues(
-    filter='volume:%s' % (volume_filter,), field_list=[
-      'id', 'volume', 'issue_number', 'store_date', 'cover_date'],
+  return client().fetch_many(
+    'volumes', 'id', volumes, field_list=['id', 'name', 'start_year'],
     sort=sort)
 
+
+ISSUE_FIELDS = ['id', 'name', 'volume', 'issue_number', 'store_date',
+                'cover_date']
+
+def issue_details(volumes, sort=None, since=None):
+  '''Retrieve issue details from comicvine.
+
+  If since is set only issues with a cover date on or after it are
+  returned.
+  '''
+  date_filter = None
+  if since:
+    date_filter = 'cover_date:%s|%s' % (
+      since.strftime('%Y-%m-%d'),
+      (date.today() + timedelta(days=366)).strftime('%Y-%m-%d'))
+  return client().fetch_many(
+    'issues', 'volume', volumes, field_list=ISSUE_FIELDS, sort=sort,
+    filter=date_filter)
+
+
+def missing_fields(issue, fields):
+  'Return the fields (and volume name) absent from an issue response.'
+  missing = [field for field in fields if field not in issue.data]
+  if 'volume' in fields and 'name' not in (issue.data.get('volume') or {}):
+    missing.append('volume')
+  return missing
+
+
+def complete_issues(issues, fields=ISSUE_FIELDS):
+  '''Make sure issues have all of fields.
+
+  Issues missing any of them are refetched together in one chunked
+  request, so the number of calls does not grow with the issues.
+  Returns the issues, with refetched issues replacing the originals.
+  '''
+  issues = list(issues)
+  incomplete = [issue.id for issue in issues
+                if missing_fields(issue, fields)]
+  if not incomplete:
+    return issues
+  logging.info('Fetching details for %d issues', len(incomplete))
+  fetched = dict((issue.id, issue) for issue in client().fetch_many(
+    'issues', 'id', incomplete, field_list=fields))
+  return [fetched.get(issue.id, issue) for issue in issues]
+
+
+def latest_issue_dates(issues):
+  'Map volume ids to the newest store (or cover) date of their issues.'
+  latest = {}
+  for issue in issues:
+    issue_date = issue.store_date or issue.cover_date
+    if issue_date and issue_date > latest.get(issue.volume.id, datetime.min):
+      latest[issue.volume.id] = issue_date
+  return latest
+
+
+def issue_pages(volumes, sort=None, start=0, before=None, readahead=None,
+                raw=False):
+  '''Retrieve pages of issue details from comicvine, starting at offset start.
+
+  If before is set only issues with a cover date on or before it are
+  returned.  With raw set the issues are response dicts.  Stale cached
+  pages are not used, as mixing them with fresh pages can hide new
+  issues.
+  '''
+  volume_filter = 'volume:%s' % '|'.join(
+    str(volume) for volume in sorted(volumes))
+  if before:
+    volume_filter += ',cover_date:1900-01-01|%s' % before.strftime('%Y-%m-%d')
+  return client().pages(
+    'issues', start=start, readahead=readahead, raw=raw, stale_ok=False,
+    filter=volume_filter, field_list=ISSUE_FIELDS, sort=sort)
+
+class Mirror(object):
+  '''Local copy of comicvine volume and issue data for pulled volumes.
+
+  Stored in the pull database so that missing, expired and listed
+  volumes can be found with local queries.  sync() refreshes the mirror
+  using date_last_updated filters so only changed data is fetched.
+  '''
+  # comicvine timestamps are not UTC, so overlap refreshes by a day.
+  overlap = timedelta(days=1)
+
+  def __init__(self, pull_list):
+    self.pull_list = pull_list
+
+  def _store(self, conn, volumes, issues):
+    'Store fetched volume and issue rows.'
+    conn.executemany(
+      'INSERT OR REPLACE INTO cv_volumes (volume, name, start_year, synced) '
+      'VALUES (?,?,?,?)', volumes)
+    conn.executemany(
+      'INSERT OR REPLACE INTO cv_issues (issue, volume, issue_number, '
+      'store_date, cover_date) VALUES (?,?,?,?,?)', issues)
+
+  def _fetch(self, volumes, since=None):
+    'Fetch volume and issue rows for volumes, optionally changed since.'
+    synced = date.today().strftime('%Y-%m-%d')
+    updated = None
+    if since:
+      updated = 'date_last_updated:%s|%s' % (
+        since.strftime('%Y-%m-%d'),
+        (date.today() + self.overlap).strftime('%Y-%m-%d'))
+    volume_rows = [
+      (volume_detail.id, volume_detail.name, volume_detail.start_year, synced)
+      for volume_detail in client().fetch_many(
+          'volumes', 'id', volumes, filter=updated,
+          field_list=['id', 'name', 'start_year'])]
+    issue_rows = [
+      (issue.id, issue.volume.id, issue.issue_number,
+       issue.store_date and issue.store_date.strftime('%Y-%m-%d'),
+       issue.cover_date and issue.cover_date.strftime('%Y-%m-%d'))
+      for issue in client().fetch_many(
+          'issues', 'volume', volumes, filter=updated,
+          field_list=['id', 'volume', 'issue_number', 'store_date',
+                      'cover_date'])]
+    return volume_rows, issue_rows
+
+  def sync(self, refresh=True):
+    '''Bring the mirror up to date.
+
+    Pulled volumes that have never been mirrored are always fetched in
+    full.  With refresh set volumes already mirrored are refreshed with
+    anything updated since their last sync.
+    '''
+    conn = self.pull_list.conn
+    synced = dict(conn.execute(
+      'SELECT pull_volumes.volume, cv_volumes.synced FROM pull_volumes '
+      'LEFT JOIN cv_volumes ON cv_volumes.volume = pull_volumes.volume'))
+    new_volumes = [volume for volume, when in synced.items() if not when]
+    if new_volumes:
+      logging.info('Mirroring %d new volumes', len(new_volumes))
+      volume_rows, issue_rows = self._fetch(new_volumes)
+      # Volumes comicvine does not return are still marked as synced so
+      # they are not refetched every run.
+      returned = set(row[0] for row in volume_rows)
+      today = date.today().strftime('%Y-%m-%d')
+      volume_rows.extend((volume, None, None, today)
+                         for volume in new_volumes if volume not in returned)
+      with self.pull_list.transaction() as conn:
+        self._store(conn, volume_rows, issue_rows)
+    old_volumes = [volume for volume, when in synced.items() if when]
+    if refresh and old_volumes:
+      since = datetime.strptime(
+        min(synced[volume] for volume in old_volumes), '%Y-%m-%d')
+      logging.info('Refreshing %d volumes updated since %s',
+                   len(old_volumes), since.date())
+      volume_rows, issue_rows = self._fetch(old_volumes, since - self.overlap)
+      today = date.today().strftime('%Y-%m-%d')
+      with self.pull_list.transaction() as conn:
+        self._store(conn, volume_rows, issue_rows)
+        conn.executemany('UPDATE cv_volumes SET synced=? WHERE volume=?',
+                         [(today, volume) for volume in old_volumes])
+    self.pull_list.update_latest_issues(
+      (volume, parse_db_date(latest)) for (volume, latest) in conn.execute(
+        'SELECT volume, MAX(COALESCE(store_date, cover_date)) '
+        'FROM cv_issues GROUP BY volume'))
+    logging.info('Mirror sync made %d requests', client().requests)
+
+  def missing_issues(self):
+    '''Generate issues of pulled volumes that have not been seen.
+
+    Yields (issue, volume, volume name, issue number, store date) tuples
+    for issues published after the volume start date, oldest first.
+    '''
+    return self.pull_list.conn.execute(
+      'SELECT cv_issues.issue, cv_issues.volume, cv_volumes.name, '
+      'cv_issues.issue_number, cv_issues.store_date FROM cv_issues '
+      'JOIN pull_volumes ON pull_volumes.volume = cv_issues.volume '
+      'LEFT JOIN cv_volumes ON cv_volumes.volume = cv_issues.volume '
+      'WHERE cv_issues.issue NOT IN ('
+      '  SELECT cvid FROM seen_issues WHERE cvid IS NOT NULL) '
+      'AND COALESCE(cv_issues.store_date, cv_issues.cover_date) >= '
+      '  COALESCE(substr(pull_volumes.start_date, 1, 10), \'\') '
+      'ORDER BY COALESCE(cv_issues.store_date, cv_issues.cover_date)')
+
+  def expired_volumes(self, cutoff):
+    'Generate (volume, name) for pulled volumes with no issues since cutoff.'
+    return self.pull_list.conn.execute(
+      'SELECT pull_volumes.volume, '
+      '  COALESCE(cv_volumes.name, pull_volumes.name) FROM pull_volumes '
+      'LEFT JOIN cv_volumes ON cv_volumes.volume = pull_volumes.volume '
+      'WHERE NOT EXISTS (SELECT 1 FROM cv_issues '
+      '  WHERE cv_issues.volume = pull_volumes.volume '
+      '  AND cv_issues.store_date >= ?)', (cutoff.strftime('%Y-%m-%d'),))
+
+  def volumes(self):
+    'Generate (volume, name, start year) for pulled volumes.'
+    return self.pull_list.conn.execute(
+      'SELECT pull_volumes.volume, '
+      '  COALESCE(cv_volumes.name, pull_volumes.name), cv_volumes.start_year '
+      'FROM pull_volumes '
+      'LEFT JOIN cv_volumes ON cv_volumes.volume = pull_volumes.volume')
+
+
+class ShardPlan(object):
+  '''A group of volumes to check for missing issues together.
+
+  Issues for all the volumes are paged newest first until the earliest
+  start date in the shard, so pages estimates how many pages of issues
+  that will take.
+  '''
+  def __init__(self, volumes, min_start, issues):
+    self.volumes = set(volumes)
+    self.min_start = min_start
+    self.issues = issues
+
+  @property
+  def pages(self):
+    'Estimated number of pages of issues the shard will fetch.'
+    return max(1, int(ceil(self.issues / float(ComicVine.page_size))))
+
+  def __repr__(self):
+    return 'ShardPlan(%d volumes from %s, ~%d pages)' % (
+      len(self.volumes), self.min_start, self.pages)
+
+
+def plan_shards(volume_starts, seen_counts=None, max_pages=10,
+                max_volumes=100, today=None):
+  '''Group volumes into shards with bounded paging depth.
+
+  volume_starts maps volume ids to start dates, and seen_counts to the
+  number of issues already seen for the volume, which is used to
+  estimate its publication rate.  Volumes are grouped newest first so a
+  single old volume does not make a shard page through decades of
+  issues for every other volume in it.  A shard is closed when adding
+  the next volume would take it over max_pages or max_volumes.
+  '''
+  seen_counts = seen_counts or {}
+  today = today or date.today()
+  earliest = date(1930, 1, 1)
+
+  def start_of(volume):
+    'Start date for a volume, clamped to a sensible range.'
+    start = volume_starts.get(volume) or date.min
+    if isinstance(start, datetime):
+      start = start.date()
+    return min(max(start, earliest), today)
+
+  def issues_per_year(volume):
+    'Estimate how many issues a volume publishes each year.'
+    years = max(1.0, (today - start_of(volume)).days / 365.25)
+    return max(1.0, seen_counts.get(volume, 0) / years)
+
+  def estimate(volumes, min_start):
+    'Estimate the issues fetched paging volumes back to min_start.'
+    total = 0.0
+    for volume in volumes:
+      since = max(start_of(volume), min_start)
+      total += issues_per_year(volume) * (today - since).days / 365.25
+    return total
+
+  shards = []
+  volumes = []
+  for volume in sorted(volume_starts, key=start_of, reverse=True):
+    min_start = start_of(volume)
+    candidate = volumes + [volume]
+    issues = estimate(candidate, min_start)
+    if volumes and (len(candidate) > max_volumes or
+                    issues / ComicVine.page_size > max_pages):
+      shards.append(ShardPlan(
+        volumes, start_of(volumes[-1]),
+        estimate(volumes, start_of(volumes[-1]))))
+      volumes = [volume]
+    else:
+      volumes = candidate
+  if volumes:
+    shards.append(ShardPlan(volumes, start_of(volumes[-1]),
+                            estimate(volumes, start_of(volumes[-1]))))
+  return shards
+
+
 class CheckShard(threading.Thread):
-  'Check shard of volumes for missing issues'
-  def __init__(self, threadid, thread_count, pull_list, retries=2):
+  '''Check shard of volumes for missing issues
+
+  Paging progress (the next page offset and the issues found so far) is
+  kept between retries, and optionally checkpointed to the pull
+  database so an interrupted check can resume where it stopped.
+
+  In frontier mode a volume is dropped from the query as soon as an
+  issue already seen for it is reached, and the remaining volumes are
+  paged with a narrowed query from that cover date on.  Missing issues
+  older than the newest seen issue in a volume are not reported in
+  this mode.
+
+  Issues are kept as response dicts keyed by comicvine id, and only
+  the missing issues are made into Issue objects.  A checkpoint saves
+  just the id, volume and dates of the issues found on each page, so
+  issues resumed from one need their other details fetched to report.
+  '''
+  backoff = 1.0
+
+  def __init__(self, threadid, plan, pull_list, retries=4, checkpoint=False,
+               frontier=False):
     super(CheckShard, self).__init__()
     self.threadid = threadid
-    self.thread_count = thread_count
+    self.plan = plan
     self.pull_list = pull_list
     self.missing_issues = set()
+    self.latest_issues = {}
+    self.error = None
     self.logger = logging.getLogger('shard-%d' % self.threadid)
     self.retries = retries
+    self.checkpoint = checkpoint
+    self.checkpoint_key = 'volume:%s' % '|'.join(
+      str(volume) for volume in sorted(plan.volumes))
+    self.frontier = frontier
+    self.offset = 0
+    self.issues = {}
+    self.done = False
+    self.active = set(plan.volumes)
+    self.before = None
+    self.parts = 0
 
-  def _sharded_to_us(self, volume):
-    'Is this volume for us?'
-    return volume % self.thread_count == self.threadid
+  def load_checkpoint(self):
+    'Resume from a checkpoint saved in the pull database.'
+    saved = self.pull_list.checkpoint(self.checkpoint_key)
+    if saved:
+      self.offset = saved['offset']
+      self.done = saved['done']
+      self.active = set(saved['active'])
+      if saved['before']:
+        self.before = parse_date(saved['before'])
+      self.parts = saved['parts']
+      for part in range(self.parts):
+        for issueid, volumeid, store_date, cover_date in (
+            self.pull_list.checkpoint('%s/%d' % (self.checkpoint_key, part))):
+          self.issues[issueid] = {'id': issueid, 'volume': {'id': volumeid},
+                                  'store_date': store_date,
+                                  'cover_date': cover_date}
+      self.logger.info('Resuming at offset %d with %d issues',
+                       self.offset, len(self.issues))
 
-  def lookup_issues(self, min_start, issues):
+  def save_checkpoint(self, issues):
+    '''Save paging progress to the pull database.
+
+    Only the issues found since the last save are written, as a new part
+    of the checkpoint.
+    '''
+    if self.checkpoint:
+      with self.pull_list.transaction():
+        if issues:
+          self.pull_list.checkpoint(
+            '%s/%d' % (self.checkpoint_key, self.parts),
+            [(issue['id'], issue['volume']['id'], issue.get('store_date'),
+              issue.get('cover_date')) for issue in issues])
+          self.parts += 1
+        self.pull_list.checkpoint(self.checkpoint_key, {
+          'offset': self.offset,
+          'done': self.done,
+          'parts': self.parts,
+          'active': sorted(self.active),
+          'before': self.before and self.before.strftime('%Y-%m-%d'),
+        })
+
+  def lookup_issues(self, min_start):
     'Attempt to lookup issues of interest using the comicvine api.'
-    # Sort by cover date rather than store date as store date is not
-    # always populated
-    for issue in issue_details(self.shard_volumes, sort='cover_date:desc'):
-      # If we retry, keep issues from the previous run
-      if issue in issues:
-        continue
-      if not isinstance(issue, pycomicvine.Issue):
-        logging.error('Issue has wrong type: %s, %r', type(issue), issue)
+    # Dates are compared as YYYY-MM-DD text rather than parsed.
+    min_date = min_start.strftime('%Y-%m-%d')
+    seen = {}
+    readahead = None
+    if self.frontier:
+      seen = self.pull_list.seen_volume_issues(self.active, cvid=True)
+      # The query is likely to be narrowed so don't fetch pages early.
+      readahead = 0
+    while not self.done:
+      narrowed = False
+      # Volumes are only dropped when the query is narrowed, so that the
+      # saved offset always belongs to the query for the active volumes.
+      caught_up = set()
+      # Sort by cover date rather than store date as store date is not
+      # always populated
+      for offset, page in issue_pages(
+          self.active, sort='cover_date:desc', start=self.offset,
+          before=self.before, readahead=readahead, raw=True):
+        found = []
+        for issue in page:
+          issue_date = issue.get('store_date') or issue.get('cover_date')
+          if issue_date and issue_date[:10] < min_date:
+            self.logger.info(
+              'Stopping search at %s [%s].  Earliest start date: %s',
+              issue.get('name'), issue_date, min_start)
+            self.done = True
+            break
+          self.issues[issue['id']] = issue
+          found.append(issue)
+          volumeid = issue['volume']['id']
+          if issue['id'] in seen.get(volumeid, ()):
+            caught_up.add(volumeid)
+        self.offset = offset + len(page)
+        caught_up &= self.active
+        if caught_up and not self.done:
+          if caught_up == self.active:
+            self.logger.debug('Caught up with all volumes')
+            self.active = set()
+            self.done = True
+          elif page[-1].get('cover_date'):
+            # Continue with the remaining volumes from this cover date.
+            self.active -= caught_up
+            self.logger.debug('Caught up with volumes %r, %d remaining',
+                              sorted(caught_up), len(self.active))
+            self.before = parse_date(page[-1]['cover_date'])
+            self.offset = 0
+            narrowed = True
+        self.save_checkpoint(found)
+        if self.done or narrowed:
+          break
+      if not narrowed:
+        self.done = True
+
+  def find_missing(self):
+    '''Compare the issues found with those seen for each volume.
+
+    Issue ids are grouped by volume in a single pass, and the newest
+    issue date of each volume is noted on the way.
+    '''
+    shard_seen = self.pull_list.seen_volume_issues(self.plan.volumes,
+                                                   cvid=True)
+    volume_issues = dict((volumeid, set()) for volumeid in self.plan.volumes)
+    latest = {}
+    for issueid, issue in self.issues.iteritems():
+      volumeid = issue['volume']['id']
+      if volumeid not in volume_issues:
         continue
-      issue_date = issue.store_date or issue.cover_date
-      if issue_date and issue_date.date() < min_start:
-        self.logger.info(
-          'Stopping search at %s [%s].  Earliest start date: %s',
-          issue.name, issue_date, min_start)
-        break
-      issues.add(issue)
-    for volume in volume_details(self.shard_volumes):
-      self.logger.debug('Checking volume %d', volume.id)
-      seen_issues = set()
-      for issue in self.pull_list.seen_issues(volume.id, cvid=True):
-        seen_issues.add(pycomicvine.Issue(issue, do_not_download=True))
-      volume_issues = set(issue for issue in issues if issue.volume == volume)
-      self.missing_issues.update(volume_issues - seen_issues)
-      # Once we have completed a volume remove it from the list so we
-      # don't have to reprocess it in case of retry.
-      self.shard_volumes.remove(volume.id)
-  
+      volume_issues[volumeid].add(issueid)
+      issue_date = issue.get('store_date') or issue.get('cover_date')
+      if issue_date and issue_date > latest.get(volumeid, ''):
+        latest[volumeid] = issue_date
+    for volumeid, issueids in volume_issues.iteritems():
+      missing = issueids - shard_seen[volumeid]
+      self.logger.debug('Volume %d: %d issues, %d missing', volumeid,
+                        len(issueids), len(missing))
+      self.missing_issues.update(
+        Issue(self.issues[issueid]) for issueid in missing)
+    self.latest_issues = dict(
+      (volumeid, parse_date(issue_date))
+      for volumeid, issue_date in latest.iteritems())
+
   def run(self):
-    'Check for issues found in comicvine but not the seen list.'
-    self.shard_volumes = set()
-    for volume in self.pull_list.volumes():
-      if self._sharded_to_us(volume):
-        self.shard_volumes.add(volume)
-    self.logger.info('Processing %d volumes', len(self.shard_volumes))
-    min_start = min(v for k,v in self.pull_list.volume_starts(
-        ).items() if k in self.shard_volumes)
-    self.logger.info('Shard start date is %s', min_start)
-    issues = set()
+    '''Check for issues found in comicvine but not the seen list.
+
+    Any error that ends the check is kept in self.error so the caller can
+    tell a failed shard from one with nothing missing.
+    '''
+    try:
+      self.check()
+    except Exception as err: # pylint: disable=W0703
+      self.logger.exception('Shard failed: %s', err)
+      self.error = err
+
+  def check(self):
+    'Look up the shard volumes and find the missing issues.'
+    self.logger.info('Processing %d volumes', len(self.plan.volumes))
+    min_start = self.plan.min_start
+    self.logger.info('Shard start date is %s (~%d pages)', min_start,
+                     self.plan.pages)
+    if self.checkpoint:
+      self.load_checkpoint()
     for retry in range(1, self.retries+1):
+      if self.done:
+        break
       # Sometimes the comicvine API will throw an exception for a good query.
-      # To account this retry the query self.retries times to see if the  
-      # error is transient.
+      # To account this retry the query self.retries times, continuing
+      # from the last completed page, to see if the error is transient.
       try:
-        self.logger.info('Run %d/%d: %d volumes remaining', retry, 
-                         self.retries, len(self.shard_volumes))
-        self.lookup_issues(min_start, issues)
+        self.logger.info('Run %d/%d: starting at offset %d', retry,
+                         self.retries, self.offset)
+        self.lookup_issues(min_start)
+      except OfflineError:
+        # Retrying cannot fill the cache.
+        raise
       # TODO(rgh): Remove NameError after bug in pycomicvine resolved.
-      except (KeyError, NameError, ValueError, InvalidResourceError) as err:
+      except (KeyError, NameError, ValueError, InvalidResourceError,
+              ComicVineError) as err:
         self.logger.error(
           "Error retrieving issue details: %r [attempt %d/%d]", 
           err, retry, self.retries)
         if retry == self.retries:
           raise
-        # API errors may indicate busy servers.  Back off for
-        # 100-600ms before retrying
-        time.sleep(random.random()/2 + 0.1)
-      else:
-        break
+        # API errors may indicate busy servers.  Back off exponentially
+        # with jitter before retrying.
+        time.sleep(self.backoff * 2 ** (retry - 1) * (1 + random.random()))
+    self.find_missing()
+    if self.checkpoint:
+      self.pull_list.checkpoint(self.checkpoint_key, clear=True)
     self.logger.info('Found %d missing issues', len(self.missing_issues))
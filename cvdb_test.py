@@ -0,0 +1,290 @@
+#!/usr/bin/python
+# Copyright 2013 Russell Heilling
+'Tests for cvdb.'
+from datetime import date, datetime
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import args
+import cvdb
+import fakecv
+import pulldb
+
+
+class CountingClient(object):
+  'Stand-in comicvine client that counts fetch_many calls.'
+  def __init__(self, issues):
+    self.issues = issues
+    self.calls = []
+
+  def fetch_many(self, resource, field, ids, **params):
+    'Return the known issues among ids.'
+    self.calls.append((resource, field, list(ids), params))
+    return [cvdb.Issue(self.issues[issueid]) for issueid in ids
+            if issueid in self.issues]
+
+
+def issue_data(issueid, **fields):
+  'Complete response data for an issue.'
+  data = {
+    'id': issueid,
+    'name': None,
+    'volume': {'id': 10, 'name': 'Volume 10'},
+    'issue_number': str(issueid),
+    'store_date': '2013-01-01',
+    'cover_date': '2013-01-01',
+  }
+  data.update(fields)
+  return data
+
+
+class CompleteIssuesTest(unittest.TestCase):
+  'Tests for completing issue details.'
+  def setUp(self):
+    self.issues = dict((issueid, issue_data(issueid))
+                       for issueid in range(1, 201))
+    self.client = CountingClient(self.issues)
+    self.saved_client = cvdb.CLIENT.get('client')
+    cvdb.CLIENT['client'] = self.client
+
+  def tearDown(self):
+    if self.saved_client is None:
+      del cvdb.CLIENT['client']
+    else:
+      cvdb.CLIENT['client'] = self.saved_client
+
+  def test_complete(self):
+    'Complete issues are returned without any requests.'
+    issues = [cvdb.Issue(data) for data in self.issues.values()]
+    self.assertEqual(cvdb.complete_issues(issues), issues)
+    self.assertEqual(self.client.calls, [])
+
+  def test_one_request(self):
+    'Incomplete issues are refetched together in one call.'
+    issues = []
+    for issueid, data in sorted(self.issues.items()):
+      if issueid % 2:
+        data = {'id': issueid, 'volume': {'id': 10}}
+      issues.append(cvdb.Issue(data))
+    completed = cvdb.complete_issues(issues)
+    self.assertEqual(len(self.client.calls), 1)
+    resource, field, ids, params = self.client.calls[0]
+    self.assertEqual((resource, field), ('issues', 'id'))
+    self.assertEqual(ids, range(1, 201, 2))
+    self.assertEqual(params, {'field_list': cvdb.ISSUE_FIELDS})
+    self.assertEqual([issue.id for issue in completed], range(1, 201))
+    for issue in completed:
+      self.assertEqual(cvdb.missing_fields(issue, cvdb.ISSUE_FIELDS), [])
+
+  def test_unknown(self):
+    'Issues that cannot be refetched are returned unchanged.'
+    issue = cvdb.Issue({'id': 500})
+    self.assertEqual(cvdb.complete_issues([issue]), [issue])
+    self.assertEqual(len(self.client.calls), 1)
+
+
+class ResponseCacheTest(unittest.TestCase):
+  'Tests for the comicvine response cache.'
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.cache_file = os.path.join(self.tmpdir, 'cache.db')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_prune_stale(self):
+    'Responses past their resource stale lifetime are deleted on open.'
+    cache = cvdb.ResponseCache(self.cache_file)
+    day = cache.day
+    now = time.time()
+    ages = {
+      'volumes?fresh': 100 * day,
+      'volumes?stale': 400 * day,
+      'issues?fresh': 6 * day,
+      'issues?stale': 8 * day,
+      'types?fresh': 6 * day,
+      'types?stale': 8 * day,
+    }
+    with cache.conn:
+      for key, age in ages.items():
+        cache.conn.execute('INSERT INTO responses VALUES (?,?,?)',
+                           (key, now - age, '{}'))
+    cache = cvdb.ResponseCache(self.cache_file)
+    keys = set(key for (key,) in cache.conn.execute(
+      'SELECT key FROM responses'))
+    self.assertEqual(keys, set(['volumes?fresh', 'issues?fresh',
+                                'types?fresh']))
+
+
+class CheckShardTest(unittest.TestCase):
+  'Tests for checking a shard of volumes for missing issues.'
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.pull_list = pulldb.PullList(os.path.join(self.tmpdir, 'pull.db'))
+    self.saved_issue_pages = cvdb.issue_pages
+    self.queries = []
+    cvdb.issue_pages = self.issue_pages
+    self.checkpoints = []
+    checkpoint = self.pull_list.checkpoint
+    def record(key, progress=None, clear=False):
+      'Record saved progress.'
+      if progress is not None and '/' not in key:
+        self.checkpoints.append(progress)
+      return checkpoint(key, progress, clear)
+    self.pull_list.checkpoint = record
+
+  def tearDown(self):
+    cvdb.issue_pages = self.saved_issue_pages
+    self.pull_list.close()
+    shutil.rmtree(self.tmpdir)
+
+  def issue_pages(self, volumes, start=0, before=None, **_):
+    'Stand-in for cvdb.issue_pages serving self.pages.'
+    self.queries.append((sorted(volumes), start, before))
+    for offset in range(start, len(self.pages)):
+      yield offset, [issue for issue in self.pages[offset]
+                     if issue['volume']['id'] in volumes]
+
+  def test_caught_up_without_date(self):
+    'Volumes stay active when the query cannot be narrowed.'
+    self.pull_list.add_issues([(1, 1, 1)])
+    # One issue per page so offsets count issues.
+    self.pages = [
+      [issue_data(1, volume={'id': 1}, cover_date=None)],
+      [issue_data(2, volume={'id': 2}, cover_date='2012-06-01')],
+      [issue_data(3, volume={'id': 1}, cover_date='2012-01-01')],
+    ]
+    plan = cvdb.ShardPlan([1, 2], date(2011, 1, 1), 1)
+    shard = cvdb.CheckShard(0, plan, self.pull_list, checkpoint=True,
+                            frontier=True)
+    shard.check()
+    self.assertEqual(shard.error, None)
+    self.assertEqual(self.checkpoints[0]['active'], [1, 2])
+    self.assertEqual(self.checkpoints[0]['offset'], 1)
+    # Narrowed at the first dated page after volume 1 was caught up.
+    self.assertEqual(self.queries[-1], ([2], 0, datetime(2012, 6, 1)))
+    self.assertEqual(set(issue.id for issue in shard.missing_issues),
+                     set([2]))
+
+
+class ClientTest(unittest.TestCase):
+  'Tests for the comicvine client against a fake comicvine server.'
+  def setUp(self):
+    args.parse_args([])
+    args.ARGS.fake_error_rate = 0.0
+    self.tmpdir = tempfile.mkdtemp()
+    self.server = fakecv.FakeComicVine(fakecv.FakeData(3, 150))
+    self.server.start()
+    self.cache = cvdb.ResponseCache(os.path.join(self.tmpdir, 'cache.db'))
+    self.client = cvdb.ComicVine(base_url=self.server.url, key='test',
+                                 cache=self.cache, rate=1000)
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.tmpdir)
+
+  def age_cache(self, age):
+    'Make every cached response age seconds old.'
+    with self.cache.conn:
+      self.cache.conn.execute('UPDATE responses SET fetched=?',
+                              (time.time() - age,))
+
+  def test_stale_pages(self):
+    'Stale cached pages are served unless stale_ok is unset.'
+    volumes = sorted(self.server.data.volumes)
+    list(self.client.pages('issues', filter='volume:%d' % volumes[0]))
+    self.age_cache(self.cache.day)
+    requests = self.client.requests
+    list(self.client.pages('issues', stale_ok=False,
+                           filter='volume:%d' % volumes[0]))
+    self.assertEqual(self.client.requests - requests, 2)
+    # Served pages are refreshed by the client pool.
+    self.age_cache(self.cache.day)
+    list(self.client.pages('issues', filter='volume:%d' % volumes[0]))
+    self.client.pool.close()
+    self.client.pool.join()
+    self.assertEqual(self.client.requests - requests, 4)
+    (age,) = self.cache.conn.execute(
+      'SELECT MAX(?-fetched) FROM responses', (time.time(),)).fetchone()
+    self.assertLess(age, 60)
+
+
+  def test_fetch_many_concurrency(self):
+    'Pages of many filter chunks are fetched no more than concurrency at once.'
+    active = [0]
+    peak = [0]
+    lock = threading.Lock()
+    get = self.client._get
+    def counting_get(url):
+      'Track the number of requests in flight.'
+      with lock:
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+      try:
+        time.sleep(0.01)
+        return get(url)
+      finally:
+        with lock:
+          active[0] -= 1
+    self.client._get = counting_get
+    self.client.concurrency = 2
+    # Each id is a filter chunk of its own.
+    filter_chunks = cvdb.filter_chunks
+    cvdb.filter_chunks = lambda ids: filter_chunks(ids, size=1)
+    try:
+      issues = list(self.client.fetch_many(
+        'issues', 'volume', self.server.data.volumes, sort='cover_date'))
+    finally:
+      cvdb.filter_chunks = filter_chunks
+    self.assertEqual(len(issues), len(self.server.data.issues))
+    self.assertEqual(self.client.requests, 6)
+    self.assertLessEqual(peak[0], self.client.concurrency)
+
+
+  def test_cancel_readahead(self):
+    'Pages read ahead are not requested once the caller stops.'
+    self.client.limiter = cvdb.TokenBucket(5, capacity=1)
+    # The second page is cached so it is read without waiting for the
+    # rate limit.
+    self.client.page('issues', {'sort': 'cover_date:desc', 'offset': 100,
+                                'limit': 100})
+    pages = self.client.pages('issues', sort='cover_date:desc')
+    # Reading the first page queues the rest of the pages.
+    pages.next()
+    pages.next()
+    pages.close()
+    self.client.pool.close()
+    self.client.pool.join()
+    self.assertEqual(self.client.requests, 2)
+
+  def test_busy_retry(self):
+    'Busy responses are retried until the page is fetched.'
+    args.ARGS.fake_error_rate = 0.5
+    # The third response is busy with this seed.
+    random.seed(0)
+    self.client.backoff = 0.001
+    self.client.retries = 20
+    issues = list(self.client.fetch_many(
+      'issues', 'volume', self.server.data.volumes, sort='cover_date'))
+    self.assertEqual(len(issues), len(self.server.data.issues))
+    # Two pages for each volume, and at least one retry.
+    self.assertGreater(self.client.requests, 6)
+
+  def test_busy_error(self):
+    'A server that stays busy is reported once the retries run out.'
+    args.ARGS.fake_error_rate = 1.0
+    self.client.backoff = 0.001
+    self.client.retries = 3
+    with self.assertRaises(cvdb.ComicVineError):
+      list(self.client.pages('issues'))
+    self.assertEqual(self.client.requests, 4)
+
+
+if __name__ == '__main__':
+  unittest.main()
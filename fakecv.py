@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# Copyright 2013 Russell Heilling
+'''Local stand-in for the comicvine API.
+
+Serves synthetic volumes and issues so that pull-list checks can be run
+and measured without contacting comicvine.  Only the parts of the API
+used by cvdb are supported: the volumes and issues resources with
+filter, sort, field_list, offset and limit parameters.
+'''
+import BaseHTTPServer
+from datetime import date, timedelta
+import json
+import logging
+import random
+import SocketServer
+import threading
+import time
+import urlparse
+
+import args
+import logs
+
+args.add_argument('--fake_port', type=int, default=0,
+                  help='Port for the fake comicvine server (default: any).')
+args.add_argument('--fake_volumes', type=int, default=200,
+                  help='Number of synthetic volumes.')
+args.add_argument('--fake_issues', type=int, default=60,
+                  help='Number of issues in each synthetic volume.')
+args.add_argument('--fake_page_size', type=int, default=100,
+                  help='Maximum results returned per request.')
+args.add_argument('--fake_latency', type=float, default=0.0,
+                  help='Seconds to wait before answering each request.')
+args.add_argument('--fake_error_rate', type=float, default=0.0,
+                  help='Fraction of requests answered as busy.')
+args.add_argument('--fake_seed', type=int, default=0,
+                  help='Random seed for the synthetic data.')
+ARGS = args.ARGS
+
+# Volume ids start here so they do not look like list indexes.
+FIRST_VOLUME = 1000
+
+
+class FakeData(object):
+  '''Synthetic comicvine volumes and issues.
+
+  Issues are published monthly.  Each volume ends some time in the last
+  year, so some volumes have had no issues recently enough to pass an
+  expiry check.
+  '''
+  def __init__(self, volumes, issues, seed=0, today=None):
+    rand = random.Random(seed)
+    today = today or date.today()
+    self.volumes = {}
+    self.issues = {}
+    self.volume_issues = {}
+    issueid = 1
+    for index in range(volumes):
+      volumeid = FIRST_VOLUME + index
+      last = today - timedelta(days=rand.randint(0, 365))
+      start = last - timedelta(days=30 * (issues - 1))
+      self.volumes[volumeid] = {
+        'id': volumeid,
+        'name': 'Volume %d' % volumeid,
+        'start_year': start.year,
+        'date_last_updated': last.strftime('%Y-%m-%d 00:00:00'),
+      }
+      volume_issues = []
+      for number in range(1, issues + 1):
+        published = start + timedelta(days=30 * (number - 1))
+        self.issues[issueid] = {
+          'id': issueid,
+          'name': None,
+          'volume': {'id': volumeid, 'name': 'Volume %d' % volumeid},
+          'issue_number': str(number),
+          'store_date': published.strftime('%Y-%m-%d'),
+          'cover_date': published.strftime('%Y-%m-%d'),
+          'date_last_updated': published.strftime('%Y-%m-%d 00:00:00'),
+        }
+        volume_issues.append(self.issues[issueid])
+        issueid += 1
+      self.volume_issues[volumeid] = volume_issues
+
+  def _ids(self, value):
+    'Parse a | separated list of ids.'
+    return set(int(ident) for ident in value.split('|') if ident)
+
+  def query(self, resource, params):
+    'Return (total, results) for a request.'
+    filters = {}
+    for condition in (params.get('filter') or '').split(','):
+      if condition:
+        field, _, value = condition.partition(':')
+        filters[field] = value
+    if resource == 'volumes':
+      if 'id' in filters:
+        results = [self.volumes[ident] for ident in self._ids(filters['id'])
+                   if ident in self.volumes]
+      else:
+        results = self.volumes.values()
+    elif resource == 'issues':
+      if 'volume' in filters:
+        results = []
+        for ident in self._ids(filters['volume']):
+          results.extend(self.volume_issues.get(ident, []))
+      elif 'id' in filters:
+        results = [self.issues[ident] for ident in self._ids(filters['id'])
+                   if ident in self.issues]
+      else:
+        results = self.issues.values()
+    else:
+      raise KeyError(resource)
+    for field, value in filters.items():
+      if field in ('id', 'volume'):
+        continue
+      low, _, high = value.partition('|')
+      results = [result for result in results
+                 if low <= (result.get(field) or '')[:len(low)] and
+                 (result.get(field) or '')[:len(high)] <= high]
+    sort_field, _, direction = (params.get('sort') or 'id').partition(':')
+    results = sorted(results, key=lambda result: result.get(sort_field),
+                     reverse=direction == 'desc')
+    total = len(results)
+    offset = int(params.get('offset', 0))
+    limit = min(int(params.get('limit', 100)), ARGS.fake_page_size)
+    results = results[offset:offset+limit]
+    if params.get('field_list'):
+      fields = params['field_list'].split(',')
+      results = [dict((field, result.get(field)) for field in fields)
+                 for result in results]
+    return total, results
+
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  'Answer comicvine API requests from the server FakeData.'
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, fmt, *values): # pylint: disable=W0221
+    logging.debug('fakecv: ' + fmt, *values)
+
+  def send_body(self, status, body):
+    'Send a response with a body.'
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    self.server.count(len(body))
+
+  def do_GET(self): # pylint: disable=C0103
+    'Answer a request.'
+    if ARGS.fake_latency:
+      time.sleep(ARGS.fake_latency)
+    url = urlparse.urlparse(self.path)
+    resource = url.path.strip('/').split('/')[-1]
+    params = dict(urlparse.parse_qsl(url.query))
+    if random.random() < ARGS.fake_error_rate:
+      self.send_body(420, 'Slow down')
+      return
+    try:
+      total, results = self.server.data.query(resource, params)
+    except (KeyError, ValueError) as err:
+      self.send_body(404, json.dumps({
+        'status_code': 101, 'error': 'Bad request: %s' % err}))
+      return
+    self.send_body(200, json.dumps({
+      'status_code': 1,
+      'error': 'OK',
+      'number_of_total_results': total,
+      'offset': int(params.get('offset', 0)),
+      'limit': len(results),
+      'results': results,
+    }))
+
+
+class FakeComicVine(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  '''Fake comicvine API server.
+
+  Requests are answered on a thread each, so persistent connections
+  from several client threads can be served at once.
+  '''
+  daemon_threads = True
+
+  def __init__(self, data, port=0):
+    BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                       FakeHandler)
+    self.data = data
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.bytes = 0
+
+  @property
+  def url(self):
+    'Base URL for the cvdb.ComicVine client.'
+    return 'http://127.0.0.1:%d' % self.server_port
+
+  def count(self, size):
+    'Record a response.'
+    with self.lock:
+      self.requests += 1
+      self.bytes += size
+
+  def start(self):
+    'Serve requests from a background thread.'
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def fake_server():
+  'A fake comicvine server configured from the command line.'
+  data = FakeData(ARGS.fake_volumes, ARGS.fake_issues, seed=ARGS.fake_seed)
+  return FakeComicVine(data, port=ARGS.fake_port)
+
+
+def main():
+  'Serve fake comicvine data until interrupted.'
+  server = fake_server()
+  logging.warn('Serving %d volumes of %d issues at %s', ARGS.fake_volumes,
+               ARGS.fake_issues, server.url)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  args.parse_args()
+  logs.set_logging()
+  main()
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+# Copyright 2013 Russell Heilling
+'''Benchmark opening the calibre library and looking up issues.
+
+Reports the time taken to open the library with the backend selected by
+--calibre_backend, to index its volumes, to look up one issue and to
+load --bench_issues issues in bulk, and the peak RSS of the process.
+Run it once for each backend, under calibre-debug for the calibre one:
+
+  calibre-debug -e library-bench.py -- --calibre_backend calibre
+  python library-bench.py --calibre_backend sqlite
+'''
+import resource
+import time
+
+import args
+import logs
+from metadatadb import open_library
+
+args.add_argument('--bench_issues', type=int, default=1000,
+                  help='Number of issues to load in bulk.')
+# Measure the backend rather than the issue cache unless one is given.
+args.set_defaults(issue_cache=None)
+ARGS = args.ARGS
+
+
+def measure(name, function):
+  'Run function and report the time taken and peak RSS so far.'
+  start = time.time()
+  result = function()
+  print '%-10s %8.3fs %8.1fMB peak RSS' % (
+    name, time.time() - start,
+    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+  return result
+
+
+def main():
+  'Run the benchmark.'
+  print 'Backend: %s' % ARGS.calibre_backend
+  library = measure('open', open_library)
+  index = measure('index', library.volume_index)
+  issueids = sorted(set().union(*index.values()))[:ARGS.bench_issues]
+  if not issueids:
+    print 'No issues tagged with a comicvine volume'
+    return
+  measure('issue', lambda: library.issue(issueids[0]))
+  issues = measure('issues', lambda: library.issues(issueids))
+  print 'Loaded %d of %d issues' % (len(issues), len(issueids))
+
+if __name__ == '__main__':
+  args.parse_args()
+  logs.set_logging()
+  main()
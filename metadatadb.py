@@ -0,0 +1,392 @@
+#!/usr/bin/python
+# Copyright 2013 Russell Heilling
+'''Lightweight read-only access to comic metadata in a calibre library.
+
+Reads metadata.db directly with sqlite3 instead of loading the whole
+library through calibre's LibraryDatabase2.  Only the fields the
+comicmgt scripts use are loaded.
+'''
+import atexit
+from collections import defaultdict, OrderedDict
+from datetime import datetime, timedelta, tzinfo
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import urllib
+
+import args
+from pulldb import chunks
+
+args.add_argument('--calibre_backend', choices=['calibre', 'sqlite'],
+                  default='calibre',
+                  help='How to read the calibre library.  sqlite reads '
+                       'metadata.db directly and is much faster to start.')
+args.add_argument('--library', help='Path to the calibre library.  Defaults '
+                  'to the library_path from the calibre configuration.')
+args.add_argument('--issue_cache', help='Location of issue metadata cache',
+                  default=os.path.join(os.environ['HOME'], '.issue-cache.db'))
+args.add_argument('--noissue_cache', help='Do not cache issue metadata.',
+                  dest='issue_cache', action='store_const', const=None)
+ARGS = args.ARGS
+
+TIMESTAMP_PATTERN = re.compile(
+  r'(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6})\d*)?)?'
+  r'(?:([+-])(\d\d):?(\d\d)|Z)?$')
+
+
+class UTCTimezone(tzinfo):
+  'UTC timezone for timestamps read from the calibre database.'
+  def utcoffset(self, moment):
+    return timedelta(0)
+
+  def tzname(self, moment):
+    return 'UTC'
+
+  def dst(self, moment):
+    return timedelta(0)
+
+UTC = UTCTimezone()
+
+
+def parse_timestamp(value):
+  'Convert a timestamp stored by calibre to an aware datetime.'
+  if not value:
+    return None
+  match = TIMESTAMP_PATTERN.match(value)
+  if not match:
+    raise ValueError('Unable to parse timestamp: %r' % value)
+  (year, month, day, hour, minute, second, fraction,
+   sign, offset_hours, offset_minutes) = match.groups()
+  timestamp = datetime(int(year), int(month), int(day), int(hour or 0),
+                       int(minute or 0), int(second or 0),
+                       int((fraction or '0').ljust(6, '0')), tzinfo=UTC)
+  if sign:
+    offset = timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+    if sign == '+':
+      timestamp -= offset
+    else:
+      timestamp += offset
+  return timestamp
+
+
+def library_path():
+  'Find the library path from the calibre configuration.'
+  config_dir = os.environ.get(
+    'CALIBRE_CONFIG_DIRECTORY',
+    os.path.join(os.environ['HOME'], '.config', 'calibre'))
+  with open(os.path.join(config_dir, 'global.py.json'), 'r') as config:
+    return json.load(config)['library_path']
+
+
+class Issue(object):
+  'The metadata for an issue used by the comicmgt scripts.'
+  __slots__ = ('id', 'title', 'series', 'pubdate', 'publisher',
+               'identifiers')
+
+  def __init__(self, calibre_id, title=None, series=None, pubdate=None,
+               publisher=None, identifiers=None):
+    self.id = calibre_id
+    self.title = title
+    self.series = series
+    self.pubdate = pubdate
+    self.publisher = publisher
+    self.identifiers = identifiers or {}
+
+  def __repr__(self):
+    return 'Issue(%r, %r)' % (self.id, self.title)
+
+
+def sqlite_uris():
+  'Whether sqlite3 treats file: filenames as URIs in this build.'
+  options = [option for (option,) in sqlite3.connect(':memory:').execute(
+    'PRAGMA compile_options')]
+  return 'USE_URI' in options or 'USE_URI=1' in options
+
+
+def connect_read_only(path):
+  '''Open a sqlite database read-only.
+
+  sqlite3 in Python 2 cannot ask for read-only access itself, so a
+  mode=ro URI is used where the sqlite build accepts URI filenames.
+  Otherwise the connection is only kept from writing by query_only.
+  '''
+  if sqlite_uris():
+    conn = sqlite3.connect('file:%s?mode=ro' % urllib.quote(
+      os.path.abspath(path)))
+  else:
+    logging.debug('sqlite URI filenames not supported, opening %r '
+                  'read-write', path)
+    conn = sqlite3.connect(path)
+  conn.execute('PRAGMA query_only=ON')
+  return conn
+
+
+class MetadataDB(object):
+  '''Read-only interface to a calibre metadata.db.
+
+  Provides the same issue lookups as calibredb.CalibreDB without loading
+  the library into memory.
+  '''
+  issue_query = (
+    'SELECT books.id, books.title, series.name, books.pubdate, '
+    'publishers.name FROM books '
+    'LEFT JOIN books_series_link ON books_series_link.book = books.id '
+    'LEFT JOIN series ON series.id = books_series_link.series '
+    'LEFT JOIN books_publishers_link ON books_publishers_link.book = books.id '
+    'LEFT JOIN publishers ON publishers.id = books_publishers_link.publisher '
+    'WHERE books.id IN (%s)')
+  search_pattern = re.compile(r'identifiers:([^:]+):=?(.+)$')
+
+  def __init__(self, library=None):
+    self.library = library or library_path()
+    metadata_db = os.path.join(self.library, 'metadata.db')
+    logging.debug('Opening calibre metadata at %r', metadata_db)
+    self.conn = connect_read_only(metadata_db)
+    self._volume_index = None
+
+  def issues(self, issueids):
+    'Retrieve several issues by calibre id.  Returns a dict keyed by id.'
+    issues = {}
+    for chunk in chunks(set(issueids)):
+      placeholders = ','.join('?' * len(chunk))
+      for (calibre_id, title, series, pubdate, publisher) in (
+          self.conn.execute(self.issue_query % placeholders, chunk)):
+        issues[calibre_id] = Issue(calibre_id, title, series,
+                                   parse_timestamp(pubdate), publisher)
+      for (calibre_id, id_type, value) in self.conn.execute(
+          'SELECT book, type, val FROM identifiers WHERE book IN (%s)' % (
+            placeholders,), chunk):
+        if calibre_id in issues:
+          issues[calibre_id].identifiers[id_type] = value
+    return issues
+
+  def issue(self, issueid):
+    'Retrieve an issue by calibre id'
+    metadata = self.issues([issueid]).get(issueid)
+    if not metadata:
+      raise ValueError('No issue with id %d' % issueid)
+    logging.debug('Found issue %s (%d) [%s/%s]',
+                  metadata.title, issueid, metadata.pubdate,
+                  metadata.publisher)
+    return metadata
+
+  def search(self, query, return_matches=True):
+    '''Find calibre ids matching an identifier query.
+
+    Only queries of the form identifiers:type:value are supported, and
+    values must match exactly.
+    '''
+    match = self.search_pattern.match(query)
+    if not match or not return_matches:
+      raise ValueError('Unsupported query: %s' % query)
+    return [calibre_id for (calibre_id,) in self.conn.execute(
+      'SELECT book FROM identifiers WHERE type=? AND val=?', match.groups())]
+
+  def volume_index(self, refresh=False):
+    'Map comicvine volume ids to the calibre ids tagged with them.'
+    if self._volume_index is None or refresh:
+      index = defaultdict(set)
+      for (calibre_id, volumeid) in self.conn.execute(
+          "SELECT book, val FROM identifiers WHERE type='comicvine-volume'"):
+        try:
+          index[int(volumeid)].add(calibre_id)
+        except ValueError:
+          logging.warn('Invalid comicvine-volume for issue %d: %r',
+                       calibre_id, volumeid)
+      self._volume_index = index
+    return self._volume_index
+
+  def volume(self, volumeid):
+    'Retrieve the calibre ids of issues in a volume by comicvine volume id'
+    return self.volume_index().get(volumeid, set())
+
+  def last_modified(self):
+    'Return the most recent modification time of any issue in the library.'
+    return self.conn.execute(
+      'SELECT MAX(last_modified) FROM books').fetchone()[0]
+
+  def modified_times(self):
+    'Return a dict mapping calibre ids to their last_modified time.'
+    return dict(self.conn.execute(
+      'SELECT id, CAST(last_modified AS TEXT) FROM books'))
+
+  def changed_volumes(self, since):
+    'Return the comicvine volume ids of issues modified after since.'
+    volumes = set()
+    for (volumeid,) in self.conn.execute(
+        "SELECT DISTINCT identifiers.val FROM identifiers "
+        "JOIN books ON books.id = identifiers.book "
+        "WHERE identifiers.type='comicvine-volume' "
+        "AND books.last_modified > ?", (since,)):
+      try:
+        volumes.add(int(volumeid))
+      except ValueError:
+        logging.warn('Invalid comicvine-volume: %r', volumeid)
+    return volumes
+
+
+class IssueCache(object):
+  '''Persistent cache of issue metadata in front of a library backend.
+
+  Issues are stored in a sqlite file (memory-mapped for reads) keyed by
+  calibre id, and are reloaded from the library when the book's
+  last_modified time changes.  A bounded LRU of Issue records sits in
+  front of the file.  Anything other than issue lookups is passed
+  through to the library.
+  '''
+  memory_size = 4096
+  mmap_size = 256 * 1024 * 1024
+
+  def __init__(self, library, cache_file):
+    self.library = library
+    self.cache_file = cache_file
+    self.memory = OrderedDict()
+    self._modified = None
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    logging.debug('Opening issue cache at %r', cache_file)
+    self.conn = sqlite3.connect(cache_file, timeout=30)
+    self.conn.execute('PRAGMA journal_mode=WAL')
+    # The cache can always be rebuilt from the library.
+    self.conn.execute('PRAGMA synchronous=OFF')
+    self.conn.execute('PRAGMA mmap_size=%d' % self.mmap_size)
+    with self.conn:
+      self.conn.execute(
+        'CREATE TABLE IF NOT EXISTS issues (id INTEGER PRIMARY KEY, '
+        'last_modified TEXT, title TEXT, series TEXT, pubdate TEXT, '
+        'publisher TEXT, identifiers TEXT)')
+
+  def __getattr__(self, name):
+    return getattr(self.library, name)
+
+  @property
+  def modified(self):
+    'last_modified times for the library, loaded once per process.'
+    if self._modified is None:
+      self._modified = self.library.modified_times()
+    return self._modified
+
+  def _remember(self, issueid, modified, metadata):
+    'Add an issue to the in-memory LRU.'
+    self.memory.pop(issueid, None)
+    self.memory[issueid] = (modified, metadata)
+    while len(self.memory) > self.memory_size:
+      self.memory.popitem(last=False)
+
+  def _from_memory(self, issueids):
+    'Find current issues in the in-memory LRU.'
+    found = {}
+    for issueid in issueids:
+      entry = self.memory.get(issueid)
+      if entry and entry[0] == self.modified.get(issueid):
+        self._remember(issueid, *entry)
+        found[issueid] = entry[1]
+    self.hits += len(found)
+    return found
+
+  def _from_disk(self, issueids):
+    'Find current issues in the cache file.'
+    found = {}
+    for chunk in chunks(issueids):
+      for (issueid, modified, title, series, pubdate, publisher,
+           identifiers) in self.conn.execute(
+             'SELECT id, last_modified, title, series, pubdate, publisher, '
+             'identifiers FROM issues WHERE id IN (%s)' % (
+               ','.join('?' * len(chunk)),), chunk):
+        if modified != self.modified.get(issueid):
+          continue
+        metadata = Issue(issueid, title, series, parse_timestamp(pubdate),
+                         publisher, json.loads(identifiers))
+        self._remember(issueid, modified, metadata)
+        found[issueid] = metadata
+    self.disk_hits += len(found)
+    return found
+
+  def _from_library(self, issueids):
+    'Load issues from the library and store them in the cache.'
+    found = {}
+    rows = []
+    for issueid, metadata in self.library.issues(issueids).items():
+      metadata = Issue(issueid, metadata.title, metadata.series,
+                       metadata.pubdate, metadata.publisher,
+                       dict(metadata.identifiers))
+      modified = self.modified.get(issueid)
+      self._remember(issueid, modified, metadata)
+      found[issueid] = metadata
+      rows.append((issueid, modified, metadata.title, metadata.series,
+                   metadata.pubdate and metadata.pubdate.isoformat(),
+                   metadata.publisher, json.dumps(metadata.identifiers)))
+    with self.conn:
+      self.conn.executemany(
+        'INSERT OR REPLACE INTO issues (id, last_modified, title, series, '
+        'pubdate, publisher, identifiers) VALUES (?,?,?,?,?,?,?)', rows)
+    self.misses += len(issueids)
+    return found
+
+  def issues(self, issueids):
+    'Retrieve several issues by calibre id.  Returns a dict keyed by id.'
+    issueids = set(issueids)
+    issues = self._from_memory(issueids)
+    if len(issues) < len(issueids):
+      issues.update(self._from_disk(issueids - set(issues)))
+    if len(issues) < len(issueids):
+      issues.update(self._from_library(issueids - set(issues)))
+    return issues
+
+  def issue(self, issueid):
+    'Retrieve an issue by calibre id'
+    metadata = self.issues([issueid]).get(issueid)
+    if not metadata:
+      raise ValueError('No issue with id %d' % issueid)
+    return metadata
+
+  def stats(self):
+    'Return the cache hit and miss counters.'
+    return {'hits': self.hits, 'disk_hits': self.disk_hits,
+            'misses': self.misses}
+
+  def close(self):
+    'Log cache statistics and close the cache file.'
+    logging.info('Issue cache: %(hits)d hits, %(disk_hits)d disk hits, '
+                 '%(misses)d misses', self.stats())
+    self.conn.close()
+
+
+def open_library():
+  '''Open the calibre library with the backend selected on the command line.
+
+  The calibre backend is only imported when used so the sqlite backend
+  can run outside calibre-debug.  Unless disabled issue lookups are
+  served through the shared IssueCache.
+  '''
+  if getattr(ARGS, 'calibre_backend', 'calibre') == 'sqlite':
+    library = MetadataDB(getattr(ARGS, 'library', None))
+  else:
+    from calibredb import CalibreDB
+    library = CalibreDB()
+  cache_file = getattr(ARGS, 'issue_cache', None)
+  if cache_file:
+    library = IssueCache(library, cache_file)
+    atexit.register(library.close)
+  return library
+
+
+def main(issues):
+  'If run as a script identify issues provided as arguments.'
+  library = MetadataDB()
+  for issue in issues:
+    try:
+      issue_data = library.issue(int(issue))
+    except ValueError:
+      print 'No issue found with id %s' % issue
+    else:
+      print 'Found issue %s(%s) [%s/%s] {%s}' % (
+        issue_data.title, issue, issue_data.pubdate, issue_data.publisher,
+        issue_data.identifiers)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
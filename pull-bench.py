@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# Copyright 2013 Russell Heilling
+'''Benchmark pull-list checks against a fake comicvine server.
+
+A pull database is built in a temporary directory from the fake
+server's synthetic volumes, with most issues of each volume already
+seen.  Each check is then run against the fake server and the wall
+time, requests and bytes transferred are reported.  pull-list options
+such as --frontier or --mirror can be given to compare their cost.
+
+The transactions benchmark instead reports the cost per row of adding
+seen issues to the pull database, committed in different ways.
+'''
+from datetime import date
+import imp
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+
+import args
+import cvdb
+import fakecv
+import logs
+from pulldb import PullList
+
+PULL_LIST = imp.load_source(
+  'pull_list', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'pull-list.py'))
+
+BENCHMARKS = ['check_missing', 'check_expired', 'do_list', 'transactions']
+
+args.add_argument('--bench', action='append', choices=BENCHMARKS,
+                  help='Checks to run (default: all).')
+args.add_argument('--bench_seen', type=float, default=0.9,
+                  help='Fraction of the issues in each volume already seen.')
+args.add_argument('--bench_rows', type=int, default=2000,
+                  help='Rows added by each transactions benchmark run.')
+# Checks are limited by the fake server, not comicvine's rate limit.
+args.set_defaults(cv_rate=1000.0)
+ARGS = args.ARGS
+
+
+def build_pull_list(pulldb, data):
+  'Pull every fake volume and mark the oldest issues of each as seen.'
+  pull_list = PullList(pulldb)
+  with pull_list.transaction() as conn:
+    for volumeid, volume in data.volumes.items():
+      conn.execute(
+        'INSERT INTO pull_volumes (volume, name, start_date) VALUES (?,?,?)',
+        (volumeid, volume['name'], date(volume['start_year'], 1, 1)))
+    seen = []
+    for volumeid, issues in data.volume_issues.items():
+      for issue in issues[:int(len(issues) * ARGS.bench_seen)]:
+        seen.append((issue['id'], volumeid, issue['id']))
+    pull_list.add_issues(seen)
+  return pull_list
+
+
+def measure(name, function, client):
+  'Run function, discarding its output, and report its cost.'
+  requests, received = client.requests, client.bytes
+  stdout = sys.stdout
+  sys.stdout = output = StringIO.StringIO()
+  start = time.time()
+  try:
+    function()
+  finally:
+    sys.stdout = stdout
+  elapsed = time.time() - start
+  print '%-14s %8.3fs %6d requests %10d bytes %6d lines' % (
+    name, elapsed, client.requests - requests, client.bytes - received,
+    len(output.getvalue().splitlines()))
+
+
+def bench_transactions(pull_list):
+  '''Report the cost per row of adding issues to the pull list.
+
+  Rows are added with a new connection and a commit for each, as before
+  connections were kept open, then with a commit for each on the kept
+  connection, then all in one transaction.  The rows are removed again
+  after each run.
+  '''
+  (first,) = pull_list.conn.execute(
+    'SELECT COALESCE(MAX(issue), 0) + 1 FROM seen_issues').fetchone()
+  rows = [(issueid, issueid % 1000, issueid) for issueid in
+          range(first, first + ARGS.bench_rows)]
+
+  def reconnect():
+    'A connection and commit for each row.'
+    for row in rows:
+      pull_list.add_issue(*row)
+      pull_list.close()
+
+  def commit():
+    'A commit for each row.'
+    for row in rows:
+      pull_list.add_issue(*row)
+
+  def batch():
+    'One transaction for all the rows.'
+    with pull_list.transaction():
+      for row in rows:
+        pull_list.add_issue(*row)
+
+  for name, function in [('reconnect', reconnect), ('commit', commit),
+                         ('transaction', batch)]:
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    with pull_list.transaction() as conn:
+      conn.execute('DELETE FROM seen_issues WHERE issue >= ?', (first,))
+    print '%-14s %8.3fs %8.1fus/row %6d rows' % (
+      name, elapsed, elapsed / len(rows) * 1e6, len(rows))
+
+
+def main():
+  'Run the benchmarks.'
+  server = fakecv.fake_server()
+  server.start()
+  client = cvdb.ComicVine(base_url=server.url, key='bench',
+                          rate=ARGS.cv_rate, concurrency=ARGS.cv_concurrency)
+  client.page_size = min(client.page_size, ARGS.fake_page_size)
+  cvdb.CLIENT['client'] = client
+  tmpdir = tempfile.mkdtemp(prefix='pull-bench')
+  try:
+    pull_list = build_pull_list(os.path.join(tmpdir, 'pull.db'),
+                                server.data)
+    print '%d volumes, %d issues, %d seen' % (
+      len(server.data.volumes), len(server.data.issues),
+      len(pull_list.seen_issue_set(server.data.issues)))
+    mirror = None
+    if ARGS.mirror or ARGS.sync:
+      mirror = cvdb.Mirror(pull_list)
+      measure('sync', mirror.sync, client)
+    for name in ARGS.bench or BENCHMARKS:
+      if name == 'transactions':
+        bench_transactions(pull_list)
+        continue
+      function = getattr(PULL_LIST, name)
+      measure(name, lambda: function(pull_list, mirror), client)
+  finally:
+    server.shutdown()
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+  args.parse_args()
+  logs.set_logging()
+  main()
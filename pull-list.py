@@ -2,6 +2,7 @@
 # Copyright 2013 Russell Heilling
 'List titles in pull-list.'
 
+from collections import deque
 from datetime import date, datetime, timedelta
 import logging
 import os
@@ -23,8 +24,26 @@ args.add_argument('--expire', '-x', action='store_true',
                   help='Check for volumes with no issues for defined period.')
 args.add_argument('--expire_limit', '-e', help='Expiry period in days',
                   default=90, type=int)
+args.add_argument('--expire_refresh', type=int, default=0,
+                  help='Refresh latest issue dates from comicvine for '
+                       'volumes within this many days of the expiry limit.')
 args.add_argument('--check', '-c', help='Check for missing issues', 
                   action='store_true')
+args.add_argument('--shard_pages', type=int, default=10,
+                  help='Maximum estimated pages of issues per check shard.')
+args.add_argument('--checkpoint', action='store_true',
+                  help='Save missing issue check progress to the pull '
+                       'database and resume from any saved progress.')
+args.add_argument('--frontier', action='store_true',
+                  help='Stop checking each volume at its newest seen issue.')
+args.add_argument('--mirror', '-m', action='store_true',
+                  help='Answer --check, --expire and --list from the local '
+                       'comicvine mirror in the pull database.')
+args.add_argument('--sync', '-s', action='store_true',
+                  help='Refresh the local comicvine mirror first.  '
+                       'Implies --mirror.')
+args.add_argument('--plan', action='store_true',
+                  help='Show the shards a missing issue check would use.')
 args.add_argument('--add', '-a', help='Add a volume to the pull list',
                   action='append')
 args.add_argument('--remove', '-r', help='Remove a volume from the pull list',
@@ -34,66 +53,165 @@ ARGS = args.ARGS
 def issue_sort_key(issue):
   return issue.store_date or issue.cover_date
 
-def check_missing(pull_list):
+def plan_shards(pull_list):
+  'Plan and log the shards for a missing issue check.'
+  volume_starts = pull_list.volume_starts()
+  seen_counts = dict(
+    (volume, len(issues)) for volume, issues in
+    pull_list.seen_volume_issues(volume_starts).items())
+  plans = cvdb.plan_shards(volume_starts, seen_counts,
+                           max_pages=ARGS.shard_pages)
+  for i, plan in enumerate(plans):
+    logging.info('Shard %d: %d volumes from %s, ~%d pages', i,
+                 len(plan.volumes), plan.min_start, plan.pages)
+  logging.info('Planned %d shards, ~%d pages in total', len(plans),
+               sum(plan.pages for plan in plans))
+  return plans
+
+def check_missing(pull_list, mirror=None):
   'Check for issues found in comicvine but not the seen list.'
   logging.info('Looking for missing issues.')
+  if mirror:
+    for issue, volume, name, issue_number, store_date in (
+        mirror.missing_issues()):
+      print 'Missing: %s #%s (%d/%d) [%s]' % (
+        name, issue_number, volume, issue, store_date)
+    return
   missing_issues = set()
-  thread_count = 8
-  threads = [cvdb.CheckShard(i, thread_count, pull_list) 
-             for i in range(thread_count)]
+  threads = [cvdb.CheckShard(i, plan, pull_list, checkpoint=ARGS.checkpoint,
+                             frontier=ARGS.frontier)
+             for i, plan in enumerate(plan_shards(pull_list))]
+  if ARGS.checkpoint:
+    # Progress saved for shards that are no longer planned is never used.
+    pull_list.clear_checkpoints(thread.checkpoint_key for thread in threads)
+  # Run up to cv_concurrency shards at a time.
+  running = deque()
   for thread in threads:
+    if len(running) >= ARGS.cv_concurrency:
+      running.popleft().join()
     thread.start()
+    running.append(thread)
   for thread in threads:
     thread.join()
+  failed = [thread for thread in threads if thread.error]
+  if failed:
+    # Partial results would under-report missing issues.
+    logging.error('%d of %d shards failed', len(failed), len(threads))
+    raise failed[0].error
+  latest_issues = []
+  for thread in threads:
     missing_issues.update(thread.missing_issues)
+    latest_issues.extend(thread.latest_issues.items())
+  pull_list.update_latest_issues(latest_issues)
   if missing_issues:
     logging.info('Found %d missing issues.', len(missing_issues))
-  volume_start = pull_list.volume_starts()
-  for issue in sorted(missing_issues, key=issue_sort_key):
+  issues = []
+  for issue in missing_issues:
     if not isinstance(issue, cvdb.Issue):
       logging.warn('Issue has wrong type: %s %r', type(issue), issue)
       continue
+    issues.append(issue)
+  # Report from complete issue details, fetched together if needed.
+  report = []
+  for issue in cvdb.complete_issues(issues):
+    if cvdb.missing_fields(issue, cvdb.ISSUE_FIELDS):
+      logging.warn('Incomplete details for issue %d', issue.id)
+      continue
+    if not issue_sort_key(issue):
+      logging.warn('No store or cover date for issue %d', issue.id)
+      continue
+    report.append(issue)
+  volume_start = pull_list.volume_starts()
+  for issue in sorted(report, key=issue_sort_key):
     issue_date = (issue.store_date or issue.cover_date).date()
     if issue_date >= volume_start[issue.volume.id]:
       print 'Missing: %s #%s (%d/%d) [%s]' % (
         issue.volume.name, issue.issue_number, issue.volume.id, 
         issue.id, issue.store_date)
 
-def check_expired(pull_list):
-  'Check for pulled volumes that have not had a new issue in a while.'
+def refresh_latest_issues(pull_list, volumes, since=None):
+  'Update the latest issue dates of volumes from comicvine.'
+  logging.info('Refreshing latest issue dates for %d volumes.', len(volumes))
+  pull_list.update_latest_issues(cvdb.latest_issue_dates(
+    cvdb.issue_details(volumes, since=since)).items())
+
+def check_expired(pull_list, mirror=None):
+  '''Check for pulled volumes that have not had a new issue in a while.
+
+  Expiry is decided from the latest issue dates kept in the pull list.
+  Volumes never checked for a latest issue date are looked up first.
+  With --expire_refresh so are volumes close to the expiry limit and
+  volumes that had no issues when checked, in case they have resumed.
+  Only issues since the cutoff are fetched, a volume with none has
+  expired.
+  '''
   logging.info('Checking for volumes with no issues within last %d days',
                ARGS.expire_limit)
   today = datetime.now()
-  pull_volumes = list(pull_list.volumes())
-  fresh_volumes = set()
-  volumes = set(cvdb.volume_details(pull_volumes))
-  issues = cvdb.issue_details(pull_volumes, sort='store_date:desc')
-  expire_limit = timedelta(int(ARGS.expire_limit))
-  for issue in issues:
-    if issue.store_date and today - issue.store_date > expire_limit:
-      break
-    fresh_volumes.add(issue.volume)
-  expired_volumes = volumes - fresh_volumes
-  for volume in expired_volumes:
+  cutoff = today - timedelta(int(ARGS.expire_limit))
+  if mirror:
+    for volume, name in mirror.expired_volumes(cutoff):
+      print 'Volume %s (%d) has no issues in last %d days.' % (
+        name, volume, int(ARGS.expire_limit))
+    return
+  cutoff = cutoff.date()
+  unknown = pull_list.unchecked_volumes()
+  if unknown:
+    refresh_latest_issues(pull_list, unknown, since=cutoff)
+    pull_list.latest_checked(unknown, cutoff)
+  if ARGS.expire_refresh:
+    margin = timedelta(ARGS.expire_refresh)
+    near = [volume for volume, issue_date in
+            pull_list.latest_issues().items()
+            if (abs(issue_date - cutoff) <= margin if issue_date
+                else volume not in unknown)]
+    if near:
+      refresh_latest_issues(pull_list, near, since=cutoff - margin)
+  expired = pull_list.expired_volumes(cutoff)
+  nameless = [volume for volume, name in expired if not name]
+  if nameless:
+    logging.info('Retrieving names for %d volumes.', len(nameless))
+    pull_list.update_volumes(cvdb.volume_details(nameless))
+    expired = pull_list.expired_volumes(cutoff)
+  for volume, name in expired:
     print 'Volume %s (%d) has no issues in last %d days.' % (
-      volume.name, volume.id, int(ARGS.expire_limit))
+      name, volume, int(ARGS.expire_limit))
 
-def do_list(pull_list):
-  'List the titles currently on the pull list.'
-  logging.info('Retrieving metadata for pulled volumes.')
-  for volume in cvdb.volume_details(pull_list.volumes()):
-    print '%d - %s (%d)' % (volume.id, volume.name, volume.start_year)
+def do_list(pull_list, mirror=None):
+  '''List the titles currently on the pull list.
+
+  Names and start dates are read from the pull list.  Only volumes
+  missing either are looked up in comicvine, and the results are saved.
+  '''
+  if mirror:
+    for volume, name, start_year in mirror.volumes():
+      print '%d - %s (%d)' % (volume, name, start_year or 0)
+    return
+  volumes = pull_list.volume_details()
+  incomplete = [volume for volume, name, start_date in volumes
+                if not (name and start_date)]
+  if incomplete:
+    logging.info('Retrieving metadata for %d volumes.', len(incomplete))
+    pull_list.update_volumes(cvdb.volume_details(incomplete))
+    volumes = pull_list.volume_details()
+  for volume, name, start_date in volumes:
+    print '%d - %s (%d)' % (volume, name, start_date and start_date.year or 0)
 
 def add_volumes(pull_list):
-  'Add new volumes to the pull list.'
+  '''Add new volumes to the pull list.
+
+  Details for all the volumes are fetched together and the volumes are
+  added in a single transaction.
+  '''
   volumes = set()
   for add_vol in ARGS.add:
     volumes.update(add_vol.split(','))
   logging.info('Found %d volumes to add.', len(volumes))
-  for volume in map(int, volumes):
-    volume_data = cvdb.Volume(volume, field_list=[
-        'id','name','start_year'])
-    pull_list.add_volume(volume, metadata=volume_data)
+  volumes = set(map(int, volumes))
+  details = list(cvdb.volume_details(volumes))
+  for volume in sorted(volumes - set(detail.id for detail in details)):
+    logging.warn('Volume %d not found in comicvine', volume)
+  pull_list.add_volumes(volumes, details)
 
 def remove_volumes(pull_list):
   'Remove volumes from the pull list.'
@@ -111,12 +229,20 @@ def main():
     add_volumes(pull_list)
   if ARGS.remove:
     remove_volumes(pull_list)
+  mirror = None
+  if ARGS.mirror or ARGS.sync:
+    mirror = cvdb.Mirror(pull_list)
+    mirror.sync(refresh=ARGS.sync)
   if ARGS.expire:
-    check_expired(pull_list)
+    check_expired(pull_list, mirror)
+  if ARGS.plan:
+    for i, plan in enumerate(plan_shards(pull_list)):
+      print 'Shard %d: %d volumes from %s, ~%d pages' % (
+        i, len(plan.volumes), plan.min_start, plan.pages)
   if ARGS.check:
-    check_missing(pull_list)
+    check_missing(pull_list, mirror)
   if ARGS.list:
-    do_list(pull_list)
+    do_list(pull_list, mirror)
 
 if __name__ == '__main__':
   args.parse_args()
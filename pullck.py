@@ -1,76 +1,116 @@
 #!/usr/bin/python
 # Copyright 2013 Russell Heilling
-'List titles in pull-list.'
+'''Repair pull-list data.
 
-from datetime import date, datetime, timedelta
+The issues and volumes to check are gathered first.  Calibre metadata is then
+loaded in bulk and comicvine volumes are looked up in chunked filter
+queries, and all fixes are written in a single transaction.
+'''
+
+from datetime import date
 import logging
 import os
 
-import pycomicvine
-
 import api_key
 import args
-from pulldb import PullList
+import cvdb
+from pulldb import PullList, chunks
 import logs
-from calibredb import CalibreDB
+from metadatadb import open_library
 
 args.add_argument('--pulldb', '-d', help='location of pull database',
                   default=os.path.join(os.environ['HOME'], '.pull.db'))
 args.add_argument('--fixissues', action='store_true',
                   help='Fill in comicvineid and volumeid for all issues')
+args.add_argument('--incomplete', action='store_true',
+                  help='Only fix issues missing a comicvineid or volumeid.')
 args.add_argument('--fixdates', action='store_true',
                   help='Set volume start dates for all volumes where not set')
 args.add_argument('--fixvolnames', action='store_true',
                   help='Set volume names for all volumes where not set.')
+args.add_argument('--dry-run', '-n', dest='dry_run', action='store_true',
+                  help='Report the repairs needed without making them.')
 ARGS = args.ARGS
 
 def fix_issues(pull_list, calibredb):
-  for volume in list(pull_list.volumes()):
-    for issue in list(pull_list.seen_issues(volume)):
-      issue = int(issue)
-      metadata = calibredb.issue(issue)
-      pull_list.add_issue(issue, volumeid=volume,
-                          cvid=int(metadata.identifiers.get('comicvine')))
-  for issue in pull_list.seen_issues(None):
-    issue = int(issue)
-    metadata = calibredb.issue(issue)
-    pull_list.add_issue(
-      issue, volumeid=int(metadata.identifiers.get('comicvine-volume')),
-      cvid=int(metadata.identifiers.get('comicvine')))
+  '''Set comicvine and volume ids of seen issues from calibre.
 
-def fix_start_dates(pull_list):
-  for volume in list(pull_list.volumes()):
-    volume_start = pull_list.start_date(volume)
-    if volume_start and volume_start > date.min:
+  Comicvine ids of issues in pulled volumes are refreshed, as are both
+  ids of issues with no volume.  With --incomplete only issues missing
+  either id are fixed.
+  '''
+  if ARGS.incomplete:
+    issues = pull_list.incomplete_issues()
+  else:
+    issues = pull_list.pulled_issues()
+  if ARGS.dry_run:
+    # The calibre backend loads each issue separately.
+    if getattr(ARGS, 'calibre_backend', 'calibre') == 'calibre':
+      lookups = len(issues)
+    else:
+      lookups = len(list(chunks(issues)))
+    print 'Would check %d issues with up to %d calibre metadata lookups.' % (
+      len(issues), lookups)
+    return
+  metadata = calibredb.issues([issue for (issue, _, _) in issues])
+  fixes = []
+  for (issue, volume, cvid) in issues:
+    try:
+      identifiers = metadata[issue].identifiers
+      fix = (issue, volume or int(identifiers['comicvine-volume']),
+             int(identifiers['comicvine']))
+    except (KeyError, TypeError, ValueError):
+      logging.warn('Unable to find comicvine ids for issue %d', issue)
+      continue
+    if fix != (issue, volume, cvid):
+      fixes.append(fix)
+  logging.info('Repairing %d of %d issues.', len(fixes), len(issues))
+  pull_list.add_issues(fixes)
+
+def fix_volumes(pull_list):
+  'Set missing start dates and names of pulled volumes.'
+  start_dates, names = [], []
+  for (volume, name, start_date) in pull_list.volume_details():
+    if ARGS.fixdates and not start_date:
+      start_dates.append(volume)
+    if ARGS.fixvolnames and not name:
+      names.append(volume)
+  volumes = set(start_dates + names)
+  if ARGS.dry_run:
+    print ('Would set %d start dates and %d names with %d comicvine '
+           'requests.') % (len(start_dates), len(names),
+                           len(list(cvdb.filter_chunks(volumes))))
+    return
+  details = {}
+  if volumes:
+    details = dict((volume_detail.id, volume_detail)
+                   for volume_detail in cvdb.volume_details(volumes))
+  for volume in sorted(volumes - set(details)):
+    logging.warn('Volume %d not found in comicvine', volume)
+  for volume in start_dates:
+    volume_detail = details.get(volume)
+    if not (volume_detail and volume_detail.start_year):
       continue
-    volume_detail = pycomicvine.Volume(volume, field_list=[
-        'id', 'name', 'start_year'])
     logging.info('Setting start year for volume: %s (%d) [%s]',
                  volume_detail.name, volume, volume_detail.start_year)
-    start_date = date(volume_detail.start_year, 1, 1)
-    pull_list.start_date(volume, start_date=start_date)
-
-def fix_volume_names(pull_list):
-  for volume in list(pull_list.volumes()):
-    name = pull_list.volume_name(volume)
-    if name:
+    pull_list.start_date(volume,
+                         start_date=date(volume_detail.start_year, 1, 1))
+  for volume in names:
+    volume_detail = details.get(volume)
+    if not (volume_detail and volume_detail.name):
       continue
-    volume_detail = pycomicvine.Volume(volume, field_list=[
-        'id', 'name', 'start_year'])
     logging.info('Setting name for volume: %s (%d) [%s]',
                  volume_detail.name, volume, volume_detail.start_year)
     pull_list.volume_name(volume, volume_detail.name)
 
 def main():
-  'Check for new issues to pull.'
+  'Repair pull-list data.'
   pull_list = PullList(ARGS.pulldb)
-  calibredb = CalibreDB()
-  if ARGS.fixissues:
-    fix_issues(pull_list, calibredb)
-  if ARGS.fixdates:
-    fix_start_dates(pull_list)
-  if ARGS.fixvolnames:
-    fix_volume_names(pull_list)
+  with pull_list.transaction():
+    if ARGS.fixissues:
+      fix_issues(pull_list, open_library())
+    if ARGS.fixdates or ARGS.fixvolnames:
+      fix_volumes(pull_list)
 
 if __name__ == '__main__':
   args.parse_args()
@@ -4,46 +4,175 @@
 
 Manage titles on pull-list and add new titles to toread list.
 '''
+from contextlib import contextmanager
 from datetime import date, datetime
+import json
 import logging
+import os
+import re
 import sqlite3
+import threading
 
 import args
 
 ARGS = args.ARGS
 
+# Keep IN (...) clauses well under sqlite's limit on bound variables.
+SQL_VARIABLE_LIMIT = 500
+
+def chunks(values, size=SQL_VARIABLE_LIMIT):
+  'Split values into lists of at most size items.'
+  values = list(values)
+  for start in range(0, len(values), size):
+    yield values[start:start+size]
+
+def parse_db_date(value):
+  '''Convert a date stored as text to a date.
+
+  Volume start_date is declared as a TIMESTAMP but holds plain dates,
+  which sqlite's timestamp converter cannot parse, so it is read as text.
+  '''
+  if not value:
+    return None
+  return datetime.strptime(value[:10], '%Y-%m-%d').date()
+
 class PullList(object):
   '''Comics pull-list object.
 
   An interface to a sqlite database containing the volumes to pull and
   the issues already pulled.
+
+  A single connection is kept open for each thread that uses the pull
+  list.  Updates made inside a transaction() block are committed
+  together when the outermost block exits, so bulk updates cost one
+  commit rather than one per row.
   '''
+  # Schema changes to apply to existing databases.  Entry n upgrades
+  # the database from schema version n to n+1, the current version is
+  # recorded in the database user_version.
+  migrations = [
+    ['CREATE INDEX IF NOT EXISTS seen_issues_volume ON seen_issues (volume)',
+     'CREATE INDEX IF NOT EXISTS seen_issues_cvid ON seen_issues (cvid)'],
+    ['CREATE TABLE IF NOT EXISTS pull_state (key TEXT PRIMARY KEY, '
+     'value TEXT)'],
+    # Local mirror of comicvine data for pulled volumes.  Dates are kept
+    # as YYYY-MM-DD text.
+    ['CREATE TABLE IF NOT EXISTS cv_volumes (volume INTEGER PRIMARY KEY, '
+     'name TEXT, start_year INTEGER, synced TEXT)',
+     'CREATE TABLE IF NOT EXISTS cv_issues (issue INTEGER PRIMARY KEY, '
+     'volume INTEGER, issue_number TEXT, store_date TEXT, cover_date TEXT)',
+     'CREATE INDEX IF NOT EXISTS cv_issues_volume ON cv_issues '
+     '(volume, store_date)'],
+    # Date of the newest issue known for each volume, as YYYY-MM-DD text.
+    ['ALTER TABLE pull_volumes ADD COLUMN latest_issue TEXT',
+     'CREATE INDEX IF NOT EXISTS pull_volumes_latest ON pull_volumes '
+     '(latest_issue)'],
+    # Date from which comicvine was searched for a volume's latest issue,
+    # so volumes with no issues since then are not searched again.
+    ['ALTER TABLE pull_volumes ADD COLUMN latest_checked TEXT'],
+  ]
+  # Columns added by a migration, see _column_exists.
+  add_column_pattern = re.compile(
+    r'ALTER TABLE (\w+) ADD COLUMN (\w+)', re.IGNORECASE)
+
   def __init__(self, pulldb):
     logging.debug('Connecting to pull database at %r', pulldb)
     self.pulldb = pulldb
+    self._local = threading.local()
     self._check_tables()
 
+  @property
+  def conn(self):
+    'The database connection for the current thread.'
+    conn = getattr(self._local, 'conn', None)
+    # Connections must not be shared with a forked child process.
+    if conn is None or self._local.pid != os.getpid():
+      conn = sqlite3.connect(self.pulldb,
+                             detect_types=sqlite3.PARSE_DECLTYPES)
+      conn.execute('PRAGMA journal_mode=WAL')
+      conn.execute('PRAGMA synchronous=NORMAL')
+      self._local.conn = conn
+      self._local.pid = os.getpid()
+      self._local.depth = 0
+    return conn
+
+  @contextmanager
+  def transaction(self):
+    '''Group updates into a single transaction.
+
+    Transactions may be nested, only the outermost block commits (or
+    rolls back on error).
+    '''
+    conn = self.conn
+    self._local.depth += 1
+    try:
+      yield conn
+    except:
+      self._local.depth -= 1
+      if not self._local.depth:
+        conn.rollback()
+      raise
+    else:
+      self._local.depth -= 1
+      if not self._local.depth:
+        conn.commit()
+
+  def close(self):
+    'Close the connection for the current thread.'
+    conn = getattr(self._local, 'conn', None)
+    if conn is not None:
+      conn.close()
+      self._local.conn = None
+
   def _check_tables(self):
     'Check the tables required exist and if not create them.'
-    with sqlite3.connect(self.pulldb) as conn:
+    with self.transaction() as conn:
       tables = [table for (table,) in conn.execute(
         "SELECT tbl_name FROM SQLITE_MASTER WHERE type = 'table'")]
       if 'pull_volumes' not in tables:
         self._create_pull_volumes()
       if 'seen_issues' not in tables:
         self._create_seen_issues()
+      self._migrate()
+
+  def _migrate(self):
+    'Bring the database schema up to the current version.'
+    with self.transaction() as conn:
+      (version,) = conn.execute('PRAGMA user_version').fetchone()
+      for target, statements in enumerate(self.migrations[version:],
+                                          version+1):
+        logging.info('Upgrading pull database to schema version %d', target)
+        for statement in statements:
+          if self._column_exists(conn, statement):
+            logging.info('Skipping %s: column already exists', statement)
+            continue
+          conn.execute(statement)
+        conn.execute('PRAGMA user_version=%d' % target)
+
+  def _column_exists(self, conn, statement):
+    '''Check whether statement adds a column that is already present.
+
+    sqlite3 commits before each ALTER, so a crash part way through a
+    migration can leave the column added without the version updated.
+    '''
+    match = self.add_column_pattern.match(statement)
+    if not match:
+      return False
+    table, column = match.groups()
+    return column in [row[1] for row in conn.execute(
+      'PRAGMA table_info(%s)' % table)]
 
   def _create_pull_volumes(self):
     'Create the pull_volumes table.'
     logging.info('Creating pull_volumes table')
-    with sqlite3.connect(self.pulldb) as conn:
+    with self.transaction() as conn:
       conn.execute("CREATE TABLE pull_volumes (volume INTEGER PRIMARY KEY, "
                    "start_date TIMESTAMP, name TEXT)")
 
   def _create_seen_issues(self):
     'Create the seen_issues table.'
     logging.info('Creating seen_issues table')
-    with sqlite3.connect(self.pulldb) as conn:
+    with self.transaction() as conn:
       conn.execute(
         "CREATE TABLE seen_issues (issue INTEGER PRIMARY KEY, cvid INTEGER, "
         "volume INTEGER)")
@@ -51,7 +180,7 @@ class PullList(object):
   def add_issue(self, issueid, volumeid=None, cvid=None):
     'Add an issue to the seen_issues table.'
     logging.debug('Adding %d to issue list.', issueid)
-    with sqlite3.connect(self.pulldb) as conn:
+    with self.transaction() as conn:
       try:
         conn.execute(
           'INSERT OR REPLACE INTO seen_issues (issue, volume, cvid) '
@@ -59,10 +188,22 @@ class PullList(object):
       except sqlite3.IntegrityError:
         logging.warn('Issue %d is already added', issueid)
 
+  def add_issues(self, issues):
+    '''Add several issues to the seen_issues table in one transaction.
+
+    issues should be an iterable of (issueid, volumeid, cvid) tuples.
+    '''
+    issues = list(issues)
+    logging.debug('Adding %d issues to issue list.', len(issues))
+    with self.transaction() as conn:
+      conn.executemany(
+        'INSERT OR REPLACE INTO seen_issues (issue, volume, cvid) '
+        'VALUES (?,?,?)', issues)
+
   def add_volume(self, volumeid, metadata=None):
     'Add a volume to the pull list.'
     logging.debug('Adding %d to volume list.', volumeid)
-    with sqlite3.connect(self.pulldb) as conn:
+    with self.transaction() as conn:
       try:
         conn.execute(
           'INSERT INTO pull_volumes (volume) VALUES (?)', (volumeid,))
@@ -74,13 +215,30 @@ class PullList(object):
           'UPDATE pull_volumes set name=?,start_date=? WHERE volume=?',
           (metadata.name, start_date, volumeid))
 
+  def add_volumes(self, volumeids, metadata=()):
+    '''Add several volumes to the pull list in one transaction.
+
+    metadata may provide comicvine details for any of the volumes.
+    '''
+    volumeids = set(volumeids)
+    logging.debug('Adding %d volumes to volume list.', len(volumeids))
+    with self.transaction() as conn:
+      for chunk in chunks(volumeids):
+        for (volumeid,) in conn.execute(
+            'SELECT volume FROM pull_volumes WHERE volume IN (%s)' % (
+              ','.join('?' * len(chunk)),), chunk):
+          logging.warn('Volume %d is already added', volumeid)
+          volumeids.discard(volumeid)
+      conn.executemany('INSERT INTO pull_volumes (volume) VALUES (?)',
+                       [(volumeid,) for volumeid in volumeids])
+      self.update_volumes(metadata)
+
   def start_date(self, volumeid, start_date=None):
     '''Returns the volume start_date.
 
     When provided start_date argument will set the date first.
     '''
-    with sqlite3.connect(self.pulldb,
-                         detect_types=sqlite3.PARSE_DECLTYPES) as conn:
+    with self.transaction() as conn:
       if start_date:
         logging.debug('Setting start date for %d(%s).', volumeid, start_date)
         if isinstance(start_date, datetime):
@@ -88,10 +246,10 @@ class PullList(object):
         conn.execute('UPDATE pull_volumes SET start_date=? WHERE volume=?',
                      (start_date, volumeid))
       row = conn.execute(
-        'SELECT start_date FROM pull_volumes WHERE volume=?', 
+        'SELECT CAST(start_date AS TEXT) FROM pull_volumes WHERE volume=?',
         (volumeid,)).fetchone()
-    if row:
-      return row[0]
+    if row and row[0]:
+      return parse_db_date(row[0])
     return date.min
     
   def volume_name(self, volumeid, name=None):
@@ -99,8 +257,7 @@ class PullList(object):
 
     When provided name argument will set the name first.
     '''
-    with sqlite3.connect(self.pulldb,
-                         detect_types=sqlite3.PARSE_DECLTYPES) as conn:
+    with self.transaction() as conn:
       if name:
         logging.debug('Setting name for volume %d(%s).', volumeid, name)
         conn.execute('UPDATE pull_volumes SET name=? WHERE volume=?',
@@ -111,11 +268,57 @@ class PullList(object):
     if row:
       return row[0]
 
+  def state(self, key, value=None):
+    '''Returns a stored state value such as a high-water mark.
+
+    When provided value argument will set the value first.
+    '''
+    with self.transaction() as conn:
+      if value is not None:
+        logging.debug('Setting state %s to %r.', key, value)
+        conn.execute('INSERT OR REPLACE INTO pull_state (key, value) '
+                     'VALUES (?,?)', (key, value))
+      row = conn.execute(
+        'SELECT value FROM pull_state WHERE key=?', (key,)).fetchone()
+    if row:
+      return row[0]
+
+  def checkpoint(self, key, progress=None, clear=False):
+    '''Returns saved progress for a long running check.
+
+    When provided progress argument will save it first.  Progress must be
+    serialisable as JSON.  Progress saved under key/part names is part of
+    the same checkpoint, and clear removes all of it.
+    '''
+    key = 'checkpoint:%s' % key
+    if clear:
+      with self.transaction() as conn:
+        conn.execute('DELETE FROM pull_state WHERE key=? OR '
+                     'substr(key, 1, ?)=?', (key, len(key) + 1, key + '/'))
+      return None
+    if progress is not None:
+      progress = json.dumps(progress)
+    value = self.state(key, progress)
+    if value:
+      return json.loads(value)
+
+  def clear_checkpoints(self, keep=()):
+    'Remove saved progress for all checkpoints except those in keep.'
+    keep = set(keep)
+    with self.transaction() as conn:
+      stale = [key for (key,) in conn.execute(
+        "SELECT key FROM pull_state WHERE key LIKE 'checkpoint:%'")
+               if key[len('checkpoint:'):].split('/')[0] not in keep]
+      if stale:
+        logging.info('Removing %d unused checkpoints.', len(stale))
+        conn.executemany('DELETE FROM pull_state WHERE key=?',
+                         [(key,) for key in stale])
+
   def remove_volume(self, volumeid):
     'Removing a volume from the pull list.'
     logging.info('Removing %d and all related issues from pull list.', 
                  volumeid)
-    with sqlite3.connect(self.pulldb) as conn:
+    with self.transaction() as conn:
       conn.execute(
         'DELETE FROM seen_issues WHERE volume=?', (volumeid,))
       conn.execute(
@@ -125,7 +328,7 @@ class PullList(object):
     'Check whether a volume is in the pull-list.'
     logging.debug('Looking up volume id %d', volumeid)
     pull = False
-    with sqlite3.connect(self.pulldb) as conn:
+    with self.transaction() as conn:
       cursor = conn.execute('SELECT volume FROM pull_volumes WHERE volume=?', 
                        (volumeid,))
       result = cursor.fetchone()
@@ -140,7 +343,7 @@ class PullList(object):
     column = 'issue'
     if cvid:
       column = 'cvid'
-    with sqlite3.connect(self.pulldb) as conn:
+    with self.transaction() as conn:
       cursor = conn.execute(
         'SELECT %s FROM seen_issues WHERE issue=?' % (column,), (issueid,))
       result = cursor.fetchone()
@@ -162,7 +365,7 @@ class PullList(object):
     column = 'issue'
     if cvid:
       column = 'cvid'
-    with sqlite3.connect(self.pulldb) as conn:
+    with self.transaction() as conn:
       cursor = conn.execute(
         'SELECT %s FROM seen_issues WHERE %s' % (column,condition), values)
       results = cursor.fetchall()
@@ -170,18 +373,126 @@ class PullList(object):
         issues = [result[0] for result in results]
     return issues
 
+  def seen_volume_issues(self, volumeids, cvid=False):
+    '''Return the issues seen for several volumes.
+
+    Returns a dict mapping each requested volume to a set of issue ids
+    (or comicvine ids if cvid is set).
+    '''
+    column = 'issue'
+    if cvid:
+      column = 'cvid'
+    volumeids = set(volumeids)
+    logging.debug('Looking up seen issues for %d volumes', len(volumeids))
+    issues = dict((volumeid, set()) for volumeid in volumeids)
+    for chunk in chunks(volumeids):
+      cursor = self.conn.execute(
+        'SELECT volume,%s FROM seen_issues WHERE volume IN (%s)' % (
+          column, ','.join('?' * len(chunk))), chunk)
+      for (volume, issue) in cursor:
+        issues[volume].add(issue)
+    return issues
+
+  def seen_issue_set(self, issueids):
+    'Return the subset of issueids that have been seen before.'
+    seen = set()
+    for chunk in chunks(issueids):
+      cursor = self.conn.execute(
+        'SELECT issue FROM seen_issues WHERE issue IN (%s)' % (
+          ','.join('?' * len(chunk)),), chunk)
+      seen.update(issue for (issue,) in cursor)
+    return seen
+
+  def incomplete_issues(self):
+    '''Return (issue, volume, cvid) for seen issues missing a volume or
+    comicvine id.'''
+    return self.conn.execute(
+      'SELECT issue,volume,cvid FROM seen_issues '
+      'WHERE cvid IS NULL OR volume IS NULL').fetchall()
+
+  def pulled_issues(self):
+    '''Return (issue, volume, cvid) for seen issues of pulled volumes and
+    seen issues with no volume.'''
+    return self.conn.execute(
+      'SELECT issue,volume,cvid FROM seen_issues WHERE volume IS NULL '
+      'OR volume IN (SELECT volume FROM pull_volumes)').fetchall()
+
   def volume_starts(self):
     'Return start dates for volumes.'
     start = {}
-    with sqlite3.connect(self.pulldb, 
-                         detect_types=sqlite3.PARSE_DECLTYPES) as conn:
-      for (volume,start_date) in conn.execute(
-        'SELECT volume,start_date FROM pull_volumes'):
-        start[volume] = start_date or date.min
+    for (volume,start_date) in self.conn.execute(
+      'SELECT volume,CAST(start_date AS TEXT) FROM pull_volumes'):
+      start[volume] = parse_db_date(start_date) or date.min
     return start
 
+  def volume_details(self):
+    'Return (volume, name, start_date) for each pulled volume.'
+    return [(volume, name, parse_db_date(start_date))
+            for (volume, name, start_date) in self.conn.execute(
+              'SELECT volume,name,CAST(start_date AS TEXT) FROM pull_volumes '
+              'ORDER BY volume')]
+
+  def update_volumes(self, metadata):
+    '''Store the name and start date of several volumes in one transaction.
+
+    metadata should be an iterable of comicvine volume details.
+    '''
+    rows = [(volume.name,
+             volume.start_year and date(volume.start_year, 1, 1),
+             volume.id) for volume in metadata]
+    logging.debug('Updating details for %d volumes.', len(rows))
+    with self.transaction() as conn:
+      conn.executemany(
+        'UPDATE pull_volumes SET name=COALESCE(?,name),'
+        'start_date=COALESCE(?,start_date) WHERE volume=?', rows)
+
+  def latest_issues(self):
+    'Return a dict mapping pulled volumes to their newest issue date.'
+    return dict(
+      (volume, parse_db_date(latest)) for (volume, latest) in
+      self.conn.execute('SELECT volume,latest_issue FROM pull_volumes'))
+
+  def unchecked_volumes(self):
+    'Return pulled volumes never searched for their newest issue date.'
+    return [volume for (volume,) in self.conn.execute(
+      'SELECT volume FROM pull_volumes '
+      'WHERE latest_issue IS NULL AND latest_checked IS NULL')]
+
+  def latest_checked(self, volumes, since):
+    '''Record that volumes were searched for issues published since a date.
+
+    Volumes with no issues since then keep a NULL latest issue date but
+    are no longer returned by unchecked_volumes.
+    '''
+    since = since.isoformat()[:10]
+    with self.transaction() as conn:
+      conn.executemany(
+        'UPDATE pull_volumes SET latest_checked=? WHERE volume=?',
+        [(since, volume) for volume in volumes])
+
+  def update_latest_issues(self, dates):
+    '''Record issue dates for volumes in one transaction.
+
+    dates should be an iterable of (volumeid, date) pairs.  A volume's
+    latest issue date only moves forward.
+    '''
+    rows = [(issue_date.isoformat()[:10], volume)
+            for (volume, issue_date) in dates if issue_date]
+    logging.debug('Updating latest issue date for %d volumes.', len(rows))
+    with self.transaction() as conn:
+      conn.executemany(
+        "UPDATE pull_volumes SET latest_issue=MAX(COALESCE(latest_issue,''),?) "
+        'WHERE volume=?', rows)
+
+  def expired_volumes(self, cutoff):
+    'Return (volume, name) for pulled volumes with no issues since cutoff.'
+    # Sorted here so that both halves of the query can use the index.
+    return sorted(self.conn.execute(
+      'SELECT volume,name FROM pull_volumes WHERE latest_issue < ? '
+      'UNION ALL SELECT volume,name FROM pull_volumes '
+      'WHERE latest_issue IS NULL', (cutoff.isoformat()[:10],)))
+
   def volumes(self):
     'Pulled volumes list generator. Returns ids only.'
-    with sqlite3.connect(self.pulldb) as conn:
-      for (volume,) in conn.execute('SELECT volume FROM pull_volumes'):
-        yield volume
+    for (volume,) in self.conn.execute('SELECT volume FROM pull_volumes'):
+      yield volume
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# Copyright 2013 Russell Heilling
+'Tests for pulldb.'
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import pulldb
+
+
+class MigrateTest(unittest.TestCase):
+  'Tests for upgrading a pull database created before schema versions.'
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.pulldb = os.path.join(self.tmpdir, 'pull.db')
+    conn = sqlite3.connect(self.pulldb)
+    conn.execute('CREATE TABLE pull_volumes (volume INTEGER PRIMARY KEY, '
+                 'start_date TIMESTAMP, name TEXT)')
+    conn.execute('CREATE TABLE seen_issues (issue INTEGER PRIMARY KEY, '
+                 'cvid INTEGER, volume INTEGER)')
+    conn.commit()
+    conn.close()
+    self.pull_list = pulldb.PullList(self.pulldb)
+
+  def tearDown(self):
+    self.pull_list.close()
+    shutil.rmtree(self.tmpdir)
+
+  def plan(self, query, values=()):
+    'Return the query plan details as one string.'
+    return ' '.join(row[-1] for row in self.pull_list.conn.execute(
+      'EXPLAIN QUERY PLAN ' + query, values))
+
+  def test_version(self):
+    'Opening an old database upgrades it to the current version.'
+    (version,) = self.pull_list.conn.execute(
+      'PRAGMA user_version').fetchone()
+    self.assertEqual(version, len(pulldb.PullList.migrations))
+
+  def test_interrupted(self):
+    'A migration that added its column before failing can be rerun.'
+    conn = self.pull_list.conn
+    conn.execute('PRAGMA user_version=%d' % (
+      len(pulldb.PullList.migrations) - 1))
+    conn.commit()
+    self.pull_list.close()
+    self.pull_list = pulldb.PullList(self.pulldb)
+    (version,) = self.pull_list.conn.execute(
+      'PRAGMA user_version').fetchone()
+    self.assertEqual(version, len(pulldb.PullList.migrations))
+
+  def test_volume_index(self):
+    'seen_issues and remove_volume use the seen_issues volume index.'
+    for query, values in [
+        ('SELECT issue FROM seen_issues WHERE volume=?', (1,)),
+        ('SELECT cvid FROM seen_issues WHERE volume=?', (1,)),
+        ('SELECT issue FROM seen_issues WHERE volume IS NULL', ()),
+        ('DELETE FROM seen_issues WHERE volume=?', (1,))]:
+      self.assertIn('seen_issues_volume', self.plan(query, values), query)
+
+  def test_cvid_index(self):
+    'Seen comicvine ids are read from the seen_issues cvid index.'
+    query = 'SELECT cvid FROM seen_issues WHERE cvid IS NOT NULL'
+    self.assertIn('seen_issues_cvid', self.plan(query))
+
+class CheckpointTest(unittest.TestCase):
+  'Tests for saved check progress.'
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.pull_list = pulldb.PullList(os.path.join(self.tmpdir, 'pull.db'))
+
+  def tearDown(self):
+    self.pull_list.close()
+    shutil.rmtree(self.tmpdir)
+
+  def keys(self):
+    'Return the saved state keys.'
+    return set(key for (key,) in self.pull_list.conn.execute(
+      'SELECT key FROM pull_state'))
+
+  def test_clear_parts(self):
+    'Clearing a checkpoint removes its parts but not similar keys.'
+    for key in ['volume:1', 'volume:1/0', 'volume:1/1', 'volume:10']:
+      self.pull_list.checkpoint(key, [key])
+    self.pull_list.checkpoint('volume:1', clear=True)
+    self.assertEqual(self.keys(), set(['checkpoint:volume:10']))
+
+  def test_clear_unused(self):
+    'Checkpoints not kept are removed with their parts.'
+    for key in ['volume:1', 'volume:1/0', 'volume:2', 'volume:2/0']:
+      self.pull_list.checkpoint(key, [key])
+    self.pull_list.state('other', 'value')
+    self.pull_list.clear_checkpoints(['volume:2'])
+    self.assertEqual(self.keys(), set(['checkpoint:volume:2',
+                                       'checkpoint:volume:2/0', 'other']))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -8,7 +8,6 @@ import sys
 
 import args
 from streams import StreamClassifier
-import calibredb
 import logs
 
 args.add_argument('--infile', '-i', help='path to input file',
@@ -23,12 +22,12 @@ def main():
   classifier.add_streams(catchup_streams=ARGS.catchup_stream, 
                          publisher_streams=ARGS.publisher)
 
-  # Open input and sort by pubdate then name
+  # Open input and sort by pubdate then name.  All lines are read
+  # first so the classifier can look up their metadata together.
   infile = ARGS.infile
   if isinstance(infile, basestring):
     infile = open(infile, 'r')
-  for line in infile:
-    classifier.identify(line)
+  classifier.identify_all(infile.readlines())
   if infile is not sys.stdin:
     infile.close()
     
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# Copyright 2013 Russell Heilling
+'''Benchmark merging toread streams.
+
+Synthetic issues are spread over catchup streams, with most left in the
+default stream, and the time taken to merge them is reported.  With
+--bench_reference the round by round merge used before the heap is
+timed on the same issues and its output compared.
+'''
+import random
+import time
+
+import args
+import logs
+import streams
+from streams_test import Library, generate, reference_merge
+
+args.add_argument('--bench_issues', type=int, default=100000,
+                  help='Number of synthetic issues.')
+args.add_argument('--bench_streams', type=int, default=50,
+                  help='Number of streams, including the default stream.')
+args.add_argument('--bench_reference', action='store_true',
+                  help='Also time the round by round merge.')
+args.add_argument('--bench_seed', type=int, default=2,
+                  help='Random seed for the synthetic issues.')
+ARGS = args.ARGS
+
+
+def classifier(issues, specs):
+  'Return a classifier with issues classified.'
+  streams.IssueStream.issue_count = 0
+  streams.IssueStream.max_stream_size = 0
+  stream_classifier = streams.StreamClassifier(Library(issues))
+  stream_classifier.add_streams(catchup_streams=specs)
+  for issue in issues:
+    stream_classifier.classify(issue)
+  return stream_classifier
+
+
+def measure(name, merge, issues, specs):
+  'Merge the issues and report the time taken.  Returns the merged lines.'
+  stream_classifier = classifier(issues, specs)
+  start = time.time()
+  merged = list(merge(stream_classifier))
+  print '%-10s %8.3fs %8d lines %4d streams' % (
+    name, time.time() - start, len(merged), len(stream_classifier.streams))
+  return merged
+
+
+def main():
+  'Run the benchmark.'
+  issues, specs = generate(random.Random(ARGS.bench_seed), ARGS.bench_issues,
+                           ARGS.bench_streams)
+  merged = measure('heap', lambda stream_classifier:
+                   stream_classifier.merged_streams(), issues, specs)
+  if ARGS.bench_reference:
+    expected = measure('reference', reference_merge, issues, specs)
+    print 'Output %s' % ('matches' if merged == expected else 'differs')
+
+if __name__ == '__main__':
+  args.parse_args()
+  logs.set_logging()
+  main()
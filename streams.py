@@ -1,13 +1,12 @@
 #!/usr/bin/python
 # Copyright 2013 Russell Heilling
 '''Sort a toread list against publication dates from the calibre database.'''
+import heapq
 import logging
 import re
 
-from collections import defaultdict
-
 import args
-from calibredb import CalibreDB
+from metadatadb import open_library
 
 args.add_argument(
   '--publisher', '-p', action='append',
@@ -105,7 +104,7 @@ class StreamClassifier(object):
   'Setup streams and provide interface to classify individual issues.'
   issue_pattern = re.compile(r'(\d+) (.*)$')
 
-  def __init__(self):
+  def __init__(self, calibredb=None):
     self.volumes = {}
     self.volumes_seen = set()
     self.publishers = {}
@@ -113,7 +112,7 @@ class StreamClassifier(object):
       None: IssueStream('default'),
     }
     self.errors = ErrorStream('ERRORS')
-    self.calibredb = CalibreDB()
+    self.calibredb = calibredb or open_library()
 
   def _add_catchup_streams(self, stream_specs):
     'Add any catchup streams to the classifier.'
@@ -151,20 +150,32 @@ class StreamClassifier(object):
 
   def identify(self, line):
     'Take an input line and classify it.'
-    line = line.strip()
-    try:
+    self.identify_all([line])
+
+  def identify_all(self, lines):
+    '''Take several input lines and classify them.
+
+    All lines are parsed first so that the metadata for every issue can
+    be fetched in one bulk query.  Lines which do not parse or are not
+    in the database are recorded as errors, as with identify.
+    '''
+    parsed = []
+    for line in lines:
+      line = line.strip()
       match = self.issue_pattern.match(line)
-      if not match:
-        raise LineError(line)
-      issue = match.group(1)
+      parsed.append((line, match and int(match.group(1))))
+    metadata = self.calibredb.issues(
+      set(issue for (_, issue) in parsed if issue is not None))
+    for line, issue in parsed:
       try:
-        metadata = self.calibredb.issue(int(issue))
-      except ValueError:
-        raise DatabaseError(line)
-      self.classify(metadata)
-    except (LineError, DatabaseError) as error:
-      logging.info('%s', error)
-      self.errors.append(error)
+        if issue is None:
+          raise LineError(line)
+        if issue not in metadata:
+          raise DatabaseError(line)
+        self.classify(metadata[issue])
+      except (LineError, DatabaseError) as error:
+        logging.info('%s', error)
+        self.errors.append(error)
 
   def classify(self, metadata):
     'Identify which classifier stream matches an issue.'
@@ -186,10 +197,18 @@ class StreamClassifier(object):
                    ','.join(unseen_volumes))
 
   def merged_streams(self):
-    'Merge the sorted streams according to relative weights.'
+    '''Merge the sorted streams according to relative weights.
+
+    Each stream is spread evenly over the length of the longest stream.
+    Issue k (counting from 1) of a stream of length n is due in round
+    ceil(k * longest / n), and issues due in the same round are yielded
+    in ascending stream weight order.  The next due issue of each stream
+    is kept in a heap, so merging N issues from S streams is O(N log S).
+
+    Rounds are computed exactly.  Summing float weights, as this used
+    to, could occasionally delay an issue by a round.
+    '''
     subtitle_match = re.compile(r':[^#]+$')
-    collected = defaultdict(float)
-    yielded = defaultdict(int)
 
     # Pass errors through first
     for error in self.errors:
@@ -217,22 +236,29 @@ class StreamClassifier(object):
                      stream.name, stream.volume_count, stream.volume_interval)
       else:
         logging.info('[%s] Stream is empty', stream.name)
-      stream_volumes = len(stream.volumes_seen)
 
-    while True:
-      done = True
-    
-      for stream in streams:
-        if len(stream) and not stream.weight:
-          raise ValueError('Weight for stream %s is zero.  '
-                           'Will never yield issues.' % stream.name)
-        if yielded[stream.name] < len(stream):
-          done = False
-          collected[stream.name] += stream.weight
-          if collected[stream.name] - yielded[stream.name] >= 1.0:
-            metadata = stream[yielded[stream.name]]
-            title = re.sub(subtitle_match, '', metadata.title)
-            yield '%d %s +%s' % (metadata.id, title, stream.name)
-            yielded[stream.name] += 1
-      if done:
-        break
+    longest = IssueStream.max_stream_size
+    def due(stream, position):
+      'The round in which the issue at position in stream is due.'
+      return -(-(position + 1) * longest // len(stream))
+
+    # Heap entries are (round due, stream order, position in stream).
+    heap = []
+    for index, stream in enumerate(streams):
+      if len(stream) and not stream.weight:
+        raise ValueError('Weight for stream %s is zero.  '
+                         'Will never yield issues.' % stream.name)
+      if len(stream):
+        heap.append((due(stream, 0), index, 0))
+    heapq.heapify(heap)
+    while heap:
+      _, index, position = heap[0]
+      stream = streams[index]
+      metadata = stream[position]
+      title = re.sub(subtitle_match, '', metadata.title)
+      yield '%d %s +%s' % (metadata.id, title, stream.name)
+      position += 1
+      if position < len(stream):
+        heapq.heapreplace(heap, (due(stream, position), index, position))
+      else:
+        heapq.heappop(heap)
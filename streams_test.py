@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# Copyright 2013 Russell Heilling
+'Tests for streams.'
+from datetime import datetime, timedelta
+from fractions import Fraction
+import os
+import random
+import re
+import shutil
+import tempfile
+import unittest
+
+from metadatadb import IssueCache
+import streams
+
+
+class Metadata(object):
+  'Issue metadata as returned from the library.'
+  # Pure data so ignore the lack of methods. pylint: disable=R0903
+  def __init__(self, issueid, volume, publisher, day):
+    self.id = issueid
+    self.title = 'Title %d: Subtitle' % issueid
+    self.series = 'Title %d' % volume
+    self.publisher = publisher
+    self.identifiers = {'comicvine-volume': str(volume)}
+    self.pubdate = datetime(2000, 1, 1) + timedelta(days=day)
+
+
+class Library(object):
+  'Library that leaves ids it does not know out, as CalibreDB.issues does.'
+  def __init__(self, issues):
+    self.metadata = dict((issue.id, issue) for issue in issues)
+
+  def issues(self, issueids):
+    'Return the known issues among issueids.'
+    return dict((issueid, self.metadata[issueid]) for issueid in issueids
+                if issueid in self.metadata)
+
+  def modified_times(self):
+    'Return the last_modified time of each issue.'
+    return dict((issueid, '2013-01-01') for issueid in self.metadata)
+
+
+def reference_merge(classifier):
+  '''Merge streams as merged_streams did before the heap.
+
+  Each round adds every stream's weight to what it has collected and
+  yields an issue from each stream that has collected a whole one.
+  Weights are kept as exact fractions.
+  '''
+  subtitle_match = re.compile(r':[^#]+$')
+  longest = streams.IssueStream.max_stream_size
+  for error in classifier.errors:
+    yield error.line
+  ordered = sorted(classifier.streams.values(),
+                   key=lambda stream: stream.weight)
+  for stream in ordered:
+    stream.sort(key=lambda metadata: metadata.pubdate)
+  collected = dict((stream.name, Fraction(0)) for stream in ordered)
+  yielded = dict((stream.name, 0) for stream in ordered)
+  while any(yielded[stream.name] < len(stream) for stream in ordered):
+    for stream in ordered:
+      if yielded[stream.name] < len(stream):
+        collected[stream.name] += Fraction(len(stream), longest)
+        if collected[stream.name] - yielded[stream.name] >= 1:
+          metadata = stream[yielded[stream.name]]
+          title = re.sub(subtitle_match, '', metadata.title)
+          yield '%d %s +%s' % (metadata.id, title, stream.name)
+          yielded[stream.name] += 1
+
+
+def generate(rand, count, stream_count):
+  'Return issues and catchup stream specs, with most in the default stream.'
+  volumes = range(1, stream_count * 3 + 1)
+  specs = ['s%d:%s' % (index, ','.join(
+    str(volume) for volume in volumes[index*3:index*3+2]))
+           for index in range(stream_count - 1)]
+  issues = []
+  for issueid in range(1, count + 1):
+    if rand.random() < 0.4:
+      volume = rand.choice(volumes)
+    else:
+      volume = volumes[-1]
+    issues.append(Metadata(issueid, volume, 'publisher',
+                           rand.randint(0, 5000)))
+  return issues, specs
+
+
+class StreamsTest(unittest.TestCase):
+  'Tests for classifying and merging streams.'
+  def classifier(self, issues, specs=None):
+    'Return a classifier with issues classified.'
+    streams.IssueStream.issue_count = 0
+    streams.IssueStream.max_stream_size = 0
+    classifier = streams.StreamClassifier(Library(issues))
+    classifier.add_streams(catchup_streams=specs)
+    for issue in issues:
+      classifier.classify(issue)
+    return classifier
+
+  def test_matches_reference(self):
+    'The heap merge gives the same order as the exact round by round merge.'
+    rand = random.Random(1)
+    for _ in range(100):
+      issues, specs = generate(rand, rand.randint(1, 300),
+                               rand.randint(1, 12))
+      expected = list(reference_merge(self.classifier(issues, specs)))
+      merged = list(self.classifier(issues, specs).merged_streams())
+      self.assertEqual(merged, expected)
+
+  def test_errors_pass_through(self):
+    '''Unparsable lines and unknown issues are passed through first.
+
+    This holds with and without the issue cache, and with a warm cache.
+    '''
+    issues, _ = generate(random.Random(2), 5, 1)
+    lines = ['%d Title %d' % (issue.id, issue.id) for issue in issues]
+    lines[1:1] = ['not an issue', '999 Unknown issue']
+    tmpdir = tempfile.mkdtemp()
+    try:
+      cache_file = os.path.join(tmpdir, 'issues.db')
+      for library in [Library(issues),
+                      IssueCache(Library(issues), cache_file),
+                      IssueCache(Library(issues), cache_file)]:
+        streams.IssueStream.issue_count = 0
+        streams.IssueStream.max_stream_size = 0
+        classifier = streams.StreamClassifier(library)
+        classifier.identify_all(lines)
+        self.assertEqual([type(error) for error in classifier.errors],
+                         [streams.LineError, streams.DatabaseError])
+        merged = list(classifier.merged_streams())
+        self.assertEqual(merged[:2], ['not an issue', '999 Unknown issue'])
+        self.assertEqual(sorted(int(line.split()[0]) for line in merged[2:]),
+                         [issue.id for issue in issues])
+    finally:
+      shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -31,6 +31,10 @@ args.add_argument('--toread', '-t', help='File containing issues to read',
                   type=bytes, default=None, required=True)
 args.add_argument('--syncdir', '-d', help='Directory to sync issues to',
                   type=bytes, default=None, required=True)
+args.add_argument('--link', action='store_true',
+                  help='Hardlink exported files to the library where '
+                       'possible instead of copying them.  Changes to a '
+                       'linked file also change the library copy.')
 
 ARGS = args.ARGS
 
@@ -283,7 +287,7 @@ def main():
   syncdir.keep_files(wanted)
 
   # Export any files not already present
-  calibredb.export_files(wanted, syncdir)
+  calibredb.export_files(wanted, syncdir, link=ARGS.link)
 
   # Rename files so they sort in reading list order
   rename_files(syncdir, toread)
@@ -9,7 +9,7 @@ import logging
 import os
 import re
 
-from calibredb import CalibreDB
+from metadatadb import open_library
 
 class ReadingList(object):
   'Manage todo.txt style reading list.'
@@ -17,7 +17,7 @@ class ReadingList(object):
 
   def __init__(self, readinglist):
     self.readinglist = readinglist
-    self.calibredb = CalibreDB()
+    self.calibredb = open_library()
 
   def add_issues(self, issues):
     'Append an issue to the reading list.'
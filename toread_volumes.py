@@ -1,7 +1,7 @@
 #!/usr/bin/python
+import os
 
 import args
-from calibredb import CalibreDB
 import logs
 from toread import ReadingList
 